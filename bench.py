@@ -0,0 +1,301 @@
+""" Benchmarks of model.py on synthetic data, written as JSON.
+
+    python bench.py                          # all the benchmarks
+    python bench.py startup latency -o results.json
+
+Each benchmark runs in a fresh interpreter, whose peak RSS (or that of its
+own child interpreters, for startup and compile) is reported with its
+results, on a synthetic dataset shaped as ours (see make_dataset):
+
+startup: time to import model (and whether theano got imported with it), to
+    construct a net, and latency of the first predict_proba (graph building
+    and compilation included) and of the following ones.
+construction: per net class, time to construct the net and to build its
+    theano graph.
+compile: per trainer (get_*_trainer), compilation time in a fresh
+    interpreter with an empty theano compile dir ('cold', the C modules of
+    the graph are built) then, in the same interpreter, for another net
+    ('warm', they are cached), so that the timings do not depend on the
+    order of the trainers or on the state of ~/.theano.
+trainers: per trainer, training samples/sec over an epoch.
+fit: per method, fit() end to end on a small set, seconds, dev error and
+    dev AUC (which is 0.5 for a method that does not train, while the dev
+    error of the majority class is about POSITIVE_RATE).
+latency: predict_proba latency (median and 95th percentile) of the compiled
+    function at several batch sizes.
+
+The results of two runs can be compared key by key: they carry the versions
+of python, numpy and theano and the THEANO_FLAGS they were run with.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy
+
+N_SAMPLES = 20000
+N_FEATURES = 300
+POSITIVE_RATE = 0.04  # imbalanced binary target
+LAYERS_SIZES = [512, 512]
+BATCH_SIZES = [1, 10, 100, 1000]
+N_REPEATS = 50
+TRAINERS = ['sgd', 'adagrad', 'adadelta', 'rmsprop']
+# learning rates of fit(): rmsprop's ReLUs all die at model.INIT_LR
+LEARNING_RATES = {'sgd': 0.01, 'adagrad': 0.01, 'rmsprop': 0.001}
+CLASSES = ['NeuralNet', 'RegularizedNet', 'DropoutNet']
+HERE = os.path.dirname(os.path.abspath(__file__))  # to import model
+
+
+def make_dataset(n_samples=N_SAMPLES, n_features=N_FEATURES,
+                 positive_rate=POSITIVE_RATE, random_state=42):
+    """ Wide float32 features (a third binary, as one-hot encoded) and an
+    int32 binary target with positive_rate positives, a noisy function of
+    the features """
+    rng = numpy.random.RandomState(random_state)
+    x = rng.randn(n_samples, n_features).astype('float32')
+    n_binary = n_features // 3
+    x[:, :n_binary] = x[:, :n_binary] > 1.
+    scores = x.dot(rng.randn(n_features) / numpy.sqrt(n_features))
+    scores += rng.randn(n_samples)
+    y = numpy.asarray(scores > numpy.percentile(scores,
+                                                100 * (1 - positive_rate)),
+                      dtype='int32')
+    return x, y
+
+
+def _net(net_class='RegularizedNet', n_ins=N_FEATURES):
+    import model
+    layers_types = [model.ReLU] * len(LAYERS_SIZES) + \
+            [model.LogisticRegression]
+    kwargs = {}
+    if net_class == 'DropoutNet':
+        kwargs['dropout_rates'] = [0.2] + [0.5] * len(LAYERS_SIZES)
+    cls = getattr(model, net_class)
+    model.add_fit_score_predict_proba(cls)
+    return cls(numpy_rng=numpy.random.RandomState(42), n_ins=n_ins,
+               layers_types=layers_types, layers_sizes=list(LAYERS_SIZES),
+               n_outs=2, **kwargs)
+
+
+def _trainer(nnet, method, given_set):
+    if method == 'sgd':
+        return nnet.get_SGD_trainer(given_set)
+    elif method == 'adagrad':
+        return nnet.get_adagrad_trainer(given_set)
+    elif method == 'adadelta':
+        return nnet.get_adadelta_trainer(given_set)
+    return nnet.get_rmsprop_trainer(given_set, with_step_adapt=True)
+
+
+_STARTUP = """
+import json, sys, time
+t0 = time.time()
+import model
+t_import = time.time() - t0
+theano_imported = 'theano' in sys.modules
+model.add_fit_score_predict_proba(model.RegularizedNet)
+import numpy
+rng = numpy.random.RandomState(42)
+t0 = time.time()
+dnn = model.RegularizedNet(numpy_rng=rng, n_ins=%(n_ins)i,
+        layers_types=[model.ReLU, model.ReLU, model.LogisticRegression],
+        layers_sizes=[200, 200], n_outs=2)
+t_construct = time.time() - t0
+x = rng.rand(%(n_rows)i, %(n_ins)i).astype('float32')
+t0 = time.time()
+dnn.predict_proba(x)
+t_first = time.time() - t0
+t0 = time.time()
+dnn.predict_proba(x)
+t_warm = time.time() - t0
+print json.dumps({'import': t_import, 'theano_imported': theano_imported,
+                  'construct': t_construct, 'first_predict_proba': t_first,
+                  'warm_predict_proba': t_warm})
+"""
+
+
+def startup(n_runs=3):
+    """ Best (min) timings over n_runs fresh interpreters """
+    runs = []
+    for _ in xrange(n_runs):
+        out = subprocess.check_output([sys.executable, '-c',
+            _STARTUP % {'n_ins': N_FEATURES, 'n_rows': 100}], cwd=HERE)
+        runs.append(json.loads(out.strip().split('\n')[-1]))
+    result = dict((k, min(r[k] for r in runs)) for k in runs[0])
+    result['theano_imported'] = any(r['theano_imported'] for r in runs)
+    result['n_runs'] = n_runs
+    return result
+
+
+def construction():
+    import theano  # not timed, see startup
+    result = {}
+    for net_class in CLASSES:
+        t0 = time.time()
+        nnet = _net(net_class)
+        t_construct = time.time() - t0
+        t0 = time.time()
+        nnet.params  # builds the graph
+        result[net_class] = {'construct': t_construct,
+                             'build_graph': time.time() - t0}
+    return result
+
+
+_COMPILE = """
+import json, time
+import bench
+from model import DatasetMiniBatchIterator
+x, y = bench.make_dataset(n_samples=100)
+result = {}
+for run in ('cold', 'warm'):
+    nnet = bench._net()
+    nnet.params
+    t0 = time.time()
+    bench._trainer(nnet, %(method)r, DatasetMiniBatchIterator(x, y))
+    result[run] = time.time() - t0
+print json.dumps(result)
+"""
+
+
+def compilation():
+    import shutil
+    import tempfile
+    result = {}
+    for method in TRAINERS:
+        compiledir = tempfile.mkdtemp(prefix='bench_compiledir_')
+        env = dict(os.environ)
+        env['THEANO_FLAGS'] = ','.join(
+                [f for f in env.get('THEANO_FLAGS', '').split(',') if f]
+                + ['base_compiledir=' + compiledir])
+        try:
+            out = subprocess.check_output([sys.executable, '-c',
+                _COMPILE % {'method': method}], cwd=HERE, env=env)
+        finally:
+            shutil.rmtree(compiledir, ignore_errors=True)
+        result[method] = json.loads(out.strip().split('\n')[-1])
+    return result
+
+
+def trainers():
+    from model import DatasetMiniBatchIterator
+    x, y = make_dataset()
+    result = {}
+    for method in TRAINERS:
+        nnet = _net()
+        iterator = DatasetMiniBatchIterator(x, y)
+        train_fn = _trainer(nnet, method, iterator)
+        lr = [] if method == 'adadelta' else [numpy.float32(0.001)]
+        train_fn(*(list(next(iter(iterator))) + lr))  # warm up
+        t0 = time.time()
+        for batch in iterator:
+            train_fn(*(list(batch) + lr))
+        seconds = time.time() - t0
+        result[method] = {'samples_per_second': x.shape[0] / seconds,
+                          'epoch_seconds': seconds}
+    return result
+
+
+def fit():
+    from sklearn.metrics import roc_auc_score
+    x, y = make_dataset(n_samples=4000)
+    n_dev = x.shape[0] // 4
+    result = {}
+    for method in TRAINERS:
+        nnet = _net('NeuralNet')  # unregularized, so that it fits quickly
+        t0 = time.time()
+        # no early stopping: the dev error stays at the majority class' for
+        # the first epochs
+        nnet.fit(x[:-n_dev], y[:-n_dev], x[-n_dev:], y[-n_dev:],
+                 max_epochs=5, method=method, early_stopping=False,
+                 learning_rate=LEARNING_RATES.get(method, 0.01))
+        seconds = time.time() - t0
+        result[method] = {'seconds': seconds,
+                          'dev_error': float(min(nnet._dev_errors)),
+                          'dev_auc': roc_auc_score(y[-n_dev:],
+                              nnet.predict_proba(x[-n_dev:])[:, 1])}
+    return result
+
+
+def latency():
+    x, _ = make_dataset(n_samples=max(BATCH_SIZES))
+    predict_proba = _net()._function('predict_proba')
+    result = {}
+    for batch_size in BATCH_SIZES:
+        batch = x[:batch_size]
+        predict_proba(batch)
+        times = []
+        for _ in xrange(N_REPEATS):
+            t0 = time.time()
+            predict_proba(batch)
+            times.append(time.time() - t0)
+        result[str(batch_size)] = {'median': numpy.median(times),
+                                   'p95': numpy.percentile(times, 95),
+                                   'rows_per_second': batch_size
+                                   / numpy.median(times)}
+    return result
+
+
+# benchmarks whose work is done in child interpreters
+IN_CHILDREN = ('startup', 'compile')
+BENCHMARKS = {'startup': startup, 'construction': construction,
+              'compile': compilation, 'trainers': trainers, 'fit': fit,
+              'latency': latency}
+ORDER = ['startup', 'construction', 'compile', 'trainers', 'fit', 'latency']
+
+
+def _run_child(name):
+    """ Runs the benchmark name and prints its results and peak RSS """
+    import resource
+    t0 = time.time()
+    result = {'results': BENCHMARKS[name]()}
+    result['seconds'] = time.time() - t0
+    # kilobytes on Linux, of the largest child for IN_CHILDREN
+    result['peak_rss_mb'] = resource.getrusage(
+            resource.RUSAGE_CHILDREN if name in IN_CHILDREN
+            else resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print json.dumps(result)
+
+
+def run(names=ORDER):
+    """ Runs the benchmarks names, each in a fresh interpreter """
+    import platform
+    import theano
+    results = {'python': platform.python_version(),
+               'numpy': numpy.__version__,
+               'theano': theano.__version__,
+               'theano_flags': os.environ.get('THEANO_FLAGS', ''),
+               'time': time.time(),
+               'data': {'n_samples': N_SAMPLES, 'n_features': N_FEATURES,
+                        'positive_rate': POSITIVE_RATE,
+                        'layers_sizes': LAYERS_SIZES},
+               'benchmarks': {}}
+    for name in names:
+        out = subprocess.check_output([sys.executable,
+                                       os.path.abspath(__file__),
+                                       '--child', name])
+        results['benchmarks'][name] = json.loads(out.strip().split('\n')[-1])
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('benchmarks', nargs='*',
+                        help="among %s (default: all)" % ', '.join(ORDER))
+    parser.add_argument('-o', '--output', help="JSON file to write the "
+                                               "results to (else stdout)")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(ORDER)
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ', '.join(sorted(unknown)))
+    if args.child:
+        _run_child(args.child)
+    else:
+        results = run(args.benchmarks or ORDER)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        else:
+            print json.dumps(results, indent=2, sort_keys=True)
@@ -0,0 +1,282 @@
+""" Streaming ingestion of a training CSV into a float32 design matrix """
+import numpy
+
+CHUNK_SIZE = 10000  # default number of CSV rows read at once
+CACHE_DIR = '.ingest_cache'  # default directory of fit_transform_cached
+CACHE_VERSION = 1  # part of the cache keys, to bump when the output changes
+
+
+class CSVIngester(object):
+    """ Imputation and one-hot encoding of a CSV file, chunk by chunk.
+
+    fit() makes one pass over the CSV to compute the means of the columns
+    (for the imputation of missing values) and the vocabularies of the
+    categorical (uppercase named) columns. transform_to_npy() makes a second
+    pass that writes the imputed, one-hot encoded float32 design matrix to a
+    memory-mapped .npy file. Peak memory is bounded by chunksize, not by the
+    size of the dataset.
+
+    The columns of the design matrix are laid out as by sklearn's
+    OneHotEncoder: the one-hot blocks of the categorical columns first, then
+    the other columns. transform_to_npz() writes it as a sparse CSR matrix
+    instead, for wide one-hot encodings.
+
+    The fitted statistics are saved and loaded by save_ingester and
+    load_ingester, so that test or serving data is transformed (see
+    iter_transform) as the training data was. fit_transform_cached() caches
+    the transformed training set on disk.
+    """
+    def __init__(self, target='TARGET', chunksize=CHUNK_SIZE, one_hot=True,
+                 oversample=True, shuffle=True, random_state=42):
+        self.target = target
+        self.chunksize = chunksize
+        self.one_hot = one_hot
+        self.oversample = oversample  # write the positive rows twice
+        self.shuffle = shuffle  # write the rows in a random order
+        self.random_state = random_state
+
+    def get_config(self):
+        return {'target': self.target, 'chunksize': self.chunksize,
+                'one_hot': self.one_hot, 'oversample': self.oversample,
+                'shuffle': self.shuffle, 'random_state': self.random_state}
+
+    def _chunks(self, csv_path):
+        import pandas as pd
+        return pd.read_csv(csv_path, chunksize=self.chunksize)
+
+    def fit(self, csv_path):
+        """ First pass: column means, categorical vocabularies, row counts """
+        sums = None
+        counts = None
+        vocabs = None
+        n_rows = 0
+        n_positives = 0
+        for chunk in self._chunks(csv_path):
+            if sums is None:
+                self.columns_ = [k for k in chunk.keys() if k != self.target]
+                self.categ_inds_ = [j for j, k in enumerate(self.columns_)
+                                    if self.one_hot and k.isupper()]
+                sums = numpy.zeros(len(self.columns_))
+                counts = numpy.zeros(len(self.columns_))
+                vocabs = [numpy.zeros(0) for _ in self.categ_inds_]
+            values = numpy.asarray(chunk[self.columns_].values,
+                                   dtype='float64')
+            nans = numpy.isnan(values)
+            sums += numpy.where(nans, 0., values).sum(axis=0)
+            counts += (~nans).sum(axis=0)
+            for i, j in enumerate(self.categ_inds_):
+                col = values[:, j]
+                vocabs[i] = numpy.union1d(vocabs[i],
+                        numpy.floor(col[~nans[:, j]]))
+            n_rows += chunk.shape[0]
+            n_positives += int((chunk[self.target].values == 1).sum())
+        self.means_ = numpy.asarray(sums / numpy.maximum(counts, 1),
+                                    dtype='float32')
+        # missing categorical values are imputed by the mean, as by Imputer
+        self.vocabs_ = [numpy.union1d(v, [numpy.floor(self.means_[j])])
+                        if counts[j] < n_rows else v
+                        for v, j in zip(vocabs, self.categ_inds_)]
+        self.num_inds_ = [j for j in xrange(len(self.columns_))
+                          if j not in set(self.categ_inds_)]
+        self.n_features_ = (sum(len(v) for v in self.vocabs_)
+                            + len(self.num_inds_))
+        self.n_rows_ = n_rows
+        self.n_positives_ = n_positives
+        return self
+
+    def transform_chunk(self, chunk, sparse=False):
+        """ Imputed, one-hot encoded float32 design matrix of a DataFrame,
+        as a scipy.sparse CSR matrix if sparse """
+        values = numpy.asarray(chunk[self.columns_].values, dtype='float32')
+        nans = numpy.isnan(values)
+        values[nans] = numpy.take(self.means_, numpy.nonzero(nans)[1])
+        n = values.shape[0]
+        rows = numpy.arange(n)
+        onehot_rows = []
+        onehot_cols = []
+        offset = 0
+        for vocab, j in zip(self.vocabs_, self.categ_inds_):
+            col = numpy.floor(values[:, j])
+            codes = numpy.minimum(numpy.searchsorted(vocab, col),
+                                  len(vocab) - 1)
+            known = vocab[codes] == col  # unseen categories stay all zeros
+            onehot_rows.append(rows[known])
+            onehot_cols.append(offset + codes[known])
+            offset += len(vocab)
+        numerical = values[:, self.num_inds_]
+        if sparse:
+            import scipy.sparse
+            num_rows, num_cols = numpy.nonzero(numerical)
+            data = numpy.concatenate([numpy.ones(sum(len(r) for r in
+                                                     onehot_rows),
+                                                 dtype='float32'),
+                                      numerical[num_rows, num_cols]])
+            return scipy.sparse.csr_matrix((data,
+                (numpy.concatenate(onehot_rows + [num_rows]),
+                 numpy.concatenate(onehot_cols + [offset + num_cols]))),
+                shape=(n, self.n_features_), dtype='float32')
+        out = numpy.zeros((n, self.n_features_), dtype='float32')
+        for r, c in zip(onehot_rows, onehot_cols):
+            out[r, c] = 1.
+        out[:, offset:] = numerical
+        return out
+
+    def iter_transform(self, csv_path, sparse=False):
+        """ Yields the design matrix of each chunk of csv_path (new data,
+        transformed with the statistics of fit) and its int32 targets, None
+        if the CSV has no target column """
+        for chunk in self._chunks(csv_path):
+            y_chunk = None
+            if self.target in chunk:
+                y_chunk = numpy.asarray(chunk[self.target].values,
+                                        dtype='int32')
+            yield self.transform_chunk(chunk, sparse=sparse), y_chunk
+
+    def transform_to_npz(self, csv_path, x_path, y_path=None):
+        """ Second pass for wide (high-cardinality) one-hot encodings: writes
+        the design matrix of csv_path as a scipy.sparse CSR .npz file. Only
+        the non-zeros of the matrix are held in memory. Returns the CSR
+        design matrix and the int32 targets. """
+        import scipy.sparse
+        xs = []
+        ys = []
+        extra_xs = []  # duplicated positive rows, after the original rows
+        for chunk in self._chunks(csv_path):
+            x_chunk = self.transform_chunk(chunk, sparse=True)
+            y_chunk = numpy.asarray(chunk[self.target].values, dtype='int32')
+            xs.append(x_chunk)
+            ys.append(y_chunk)
+            if self.oversample:
+                extra_xs.append(x_chunk[numpy.nonzero(y_chunk == 1)[0]])
+        if extra_xs:
+            ys.append(numpy.ones((sum(e.shape[0] for e in extra_xs),),
+                                 dtype='int32'))
+        x = scipy.sparse.vstack(xs + extra_xs, format='csr')
+        y = numpy.concatenate(ys)
+        del xs, extra_xs
+        if self.shuffle:
+            # the i-th row goes to order[i], as in transform_to_npy
+            from sklearn.utils import check_random_state
+            order = check_random_state(self.random_state).permutation(
+                    x.shape[0])
+            inverse = numpy.argsort(order)
+            x = x[inverse]
+            y = y[inverse]
+        scipy.sparse.save_npz(x_path, x)
+        if y_path is not None:
+            numpy.save(y_path, y)
+        return x, y
+
+    def transform_to_npy(self, csv_path, x_path, y_path=None):
+        """ Second pass: writes the design matrix of csv_path to the .npy
+        file x_path (and the targets to y_path if given). Returns the
+        design matrix memory-mapped read-only and the int32 targets. """
+        from numpy.lib.format import open_memmap
+        n_rows = self.n_rows_
+        if self.oversample:
+            n_rows += self.n_positives_
+        x = open_memmap(x_path, mode='w+', dtype='float32',
+                        shape=(n_rows, self.n_features_))
+        y = numpy.empty((n_rows,), dtype='int32')
+        if self.shuffle:
+            from sklearn.utils import check_random_state
+            order = check_random_state(self.random_state).permutation(n_rows)
+        else:
+            order = numpy.arange(n_rows)
+        start = 0  # next row of the original rows
+        extra = self.n_rows_  # next row of the duplicated positive rows
+        for chunk in self._chunks(csv_path):
+            x_chunk = self.transform_chunk(chunk)
+            y_chunk = numpy.asarray(chunk[self.target].values, dtype='int32')
+            rows = order[start:start + x_chunk.shape[0]]
+            x[rows] = x_chunk
+            y[rows] = y_chunk
+            start += x_chunk.shape[0]
+            if self.oversample:
+                positives = y_chunk == 1
+                rows = order[extra:extra + positives.sum()]
+                x[rows] = x_chunk[positives]
+                y[rows] = 1
+                extra += rows.shape[0]
+        x.flush()
+        del x
+        if y_path is not None:
+            numpy.save(y_path, y)
+        return numpy.load(x_path, mmap_mode='r'), y
+
+    def fit_transform_cached(self, csv_path, cache_dir=CACHE_DIR,
+                             sparse=False):
+        """ fit() and transform_to_npy() (transform_to_npz() if sparse) of
+        csv_path, cached in cache_dir under a key of the content of the file
+        and of the configuration: a cache hit loads the fitted statistics
+        and the design matrix (memory-mapped if dense) instead. Returns the
+        design matrix and the int32 targets. """
+        import os, json, hashlib
+        digest = hashlib.sha1()
+        with open(csv_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                digest.update(block)
+        config = self.get_config()
+        del config['chunksize']  # does not change the output
+        digest.update(json.dumps([config, sparse, CACHE_VERSION],
+                                 sort_keys=True))
+        path = os.path.join(cache_dir, digest.hexdigest())
+        x_path = os.path.join(path, 'X.npz' if sparse else 'X.npy')
+        y_path = os.path.join(path, 'y.npy')
+        if os.path.exists(os.path.join(path, 'ingester', 'ingester.json')):
+            fitted = load_ingester(os.path.join(path, 'ingester'))
+            self.__dict__.update((k, v) for k, v in fitted.__dict__.items()
+                                 if k.endswith('_'))
+            if sparse:
+                import scipy.sparse
+                x = scipy.sparse.load_npz(x_path)
+            else:
+                x = numpy.load(x_path, mmap_mode='r')
+            return x, numpy.load(y_path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.fit(csv_path)
+        if sparse:
+            x, y = self.transform_to_npz(csv_path, x_path, y_path)
+        else:
+            x, y = self.transform_to_npy(csv_path, x_path, y_path)
+        # written last: marks the entry as complete
+        save_ingester(self, os.path.join(path, 'ingester'))
+        return x, y
+
+
+def save_ingester(ingester, path):
+    """ Saves the configuration and fitted statistics of ingester in the
+    directory path """
+    import os, json
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    numpy.save(os.path.join(path, 'means.npy'), ingester.means_)
+    for i, vocab in enumerate(ingester.vocabs_):
+        numpy.save(os.path.join(path, 'vocab_%03d.npy' % i), vocab)
+    with open(os.path.join(path, 'ingester.json'), 'w') as f:
+        json.dump({'config': ingester.get_config(),
+                   'columns_': ingester.columns_,
+                   'categ_inds_': ingester.categ_inds_,
+                   'num_inds_': ingester.num_inds_,
+                   'n_features_': ingester.n_features_,
+                   'n_rows_': ingester.n_rows_,
+                   'n_positives_': ingester.n_positives_}, f)
+
+
+def load_ingester(path):
+    """ Rebuilds the fitted CSVIngester saved by save_ingester in the
+    directory path """
+    import os, json
+    with open(os.path.join(path, 'ingester.json')) as f:
+        meta = json.load(f)
+    config = dict((str(k), v) for k, v in meta.pop('config').iteritems())
+    config['target'] = str(config['target'])
+    ingester = CSVIngester(**config)
+    for k, v in meta.iteritems():
+        setattr(ingester, str(k), v)
+    ingester.columns_ = [str(c) for c in ingester.columns_]
+    ingester.means_ = numpy.load(os.path.join(path, 'means.npy'))
+    ingester.vocabs_ = [numpy.load(os.path.join(path, 'vocab_%03d.npy' % i))
+                        for i in xrange(len(ingester.categ_inds_))]
+    return ingester
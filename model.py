@@ -1,16 +1,38 @@
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.preprocessing import Imputer
-from sklearn.pipeline import Pipeline
-import theano, sys
-from theano import tensor as T
-from theano import shared
-from theano.tensor.shared_randomstreams import RandomStreams
-from collections import OrderedDict
+import sys, importlib
+from collections import OrderedDict, deque
 import numpy
 
+
+class _LazyModule(object):
+    """ Module imported on first attribute access, so that importing this
+    file does not pay for theano (or scipy) on code paths that do not use it
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+theano = _LazyModule('theano')
+T = _LazyModule('theano.tensor')
+S = _LazyModule('theano.sparse')
+sp = _LazyModule('scipy.sparse')
+
+
+def shared(*args, **kwargs):
+    """ theano.shared """
+    return theano.shared(*args, **kwargs)
+
+
 BATCH_SIZE = 100  # default batch size
 L2_LAMBDA = 1.    # default L2 regularization parameter
 INIT_LR = 0.01    # initial learning rate, try making it larger
+MAX_SHARED_BYTES = 512 * 1024 ** 2  # memory budget for datasets kept in
+                                    # theano shared variables
 
 
 def relu_f(vec):
@@ -18,17 +40,44 @@ def relu_f(vec):
     return (vec + abs(vec)) / 2.
 
 
-def dropout(rng, x, p=0.5):
-    """ Zero-out random values in x with probability p using rng """
+def dot(x, W):
+    """ T.dot(x, W), with a structured dot if x is sparse """
+    if isinstance(x.type, S.SparseType):
+        return S.structured_dot(x, W)
+    return T.dot(x, W)
+
+
+def dropout(srng, x, p=0.5):
+    """ Inverted dropout: zero-out random values in x with probability p
+    using the random streams srng, and scale the others by 1 / (1 - p) so
+    that nothing changes at inference. """
     if p > 0. and p < 1.:
-        seed = rng.randint(2 ** 30)
-        srng = theano.tensor.shared_randomstreams.RandomStreams(seed)
-        mask = srng.binomial(n=1, p=1.-p, size=x.shape,
-                dtype=theano.config.floatX)
-        return x * mask
+        mask = srng.binomial(n=1, p=1.-p, size=x.shape, dtype=x.dtype)
+        return x * (mask * numpy.asarray(1. / (1. - p), dtype=x.dtype))
     return x
 
 
+def sample_weights(y, class_weight=None, sample_weight=None):
+    """ float32 per-sample weights of the targets y, from a {class: weight}
+    dict (or 'balanced', for weights inversely proportional to the class
+    frequencies) and/or given per-sample weights """
+    if sample_weight is None:
+        w = numpy.ones(y.shape, dtype='float32')
+    else:
+        w = numpy.asarray(sample_weight, dtype='float32')
+    if class_weight == 'balanced':
+        counts = numpy.bincount(y)
+        w = w * (float(y.shape[0]) / (len(counts)
+                 * numpy.maximum(counts, 1)))[y].astype('float32')
+    elif class_weight is not None:
+        weights = numpy.ones(max(class_weight.keys() + [y.max()]) + 1,
+                             dtype='float32')
+        for k, v in class_weight.iteritems():
+            weights[k] = v
+        w = w * weights[y]
+    return w
+
+
 def build_shared_zeros(shape, name):
     """ Builds a theano shared variable filled with a zeros numpy array """
     return shared(value=numpy.zeros(shape, dtype=theano.config.floatX),
@@ -51,7 +100,7 @@ class Linear(object):
         self.W = W
         self.b = b
         self.params = [self.W, self.b]
-        self.output = T.dot(self.input, self.W) + self.b
+        self.output = dot(self.input, self.W) + self.b
 
     def __repr__(self):
         return "Linear"
@@ -76,36 +125,250 @@ class ReLU(Linear):
 
 
 class DatasetMiniBatchIterator(object):
-    """ Basic mini-batch iterator """
-    def __init__(self, x, y=None, batch_size=BATCH_SIZE, randomize=False):
+    """ Basic mini-batch iterator
+
+    With randomize=True, the dataset is shuffled with one permutation per
+    epoch: the minibatches are gathered (as contiguous copies) from the rows
+    of x (and y) in the permuted order or, with block_shuffle=True, only the
+    order of the batch_size blocks of rows is permuted and the minibatches
+    are views on x (and y). With drop_last=True, the last minibatch is
+    dropped if it is shorter than batch_size.
+    x can be a scipy.sparse CSR matrix, whose rows are sliced without
+    densifying it. If sample weights w are given, (x, y, w) minibatches are
+    yielded.
+    """
+    def __init__(self, x, y=None, batch_size=BATCH_SIZE, randomize=False,
+                 block_shuffle=False, drop_last=False, random_state=42,
+                 w=None):
         self.x = x
         self.y = y
+        self.w = w
         self.batch_size = batch_size
         self.randomize = randomize
+        self.block_shuffle = block_shuffle
+        self.drop_last = drop_last
         from sklearn.utils import check_random_state
-        self.rng = check_random_state(42)
+        self.rng = check_random_state(random_state)
 
-    def __iter__(self):
+    def __len__(self):
         n_samples = self.x.shape[0]
-        if self.randomize:
-            for _ in xrange(n_samples / BATCH_SIZE):
-                if BATCH_SIZE > 1:
-                    i = int(self.rng.rand(1) * ((n_samples+BATCH_SIZE-1) / BATCH_SIZE))
-                else:
-                    i = int(math.floor(self.rng.rand(1) * n_samples))
-                if self.y != None:
-                    yield (i, self.x[i*self.batch_size:(i+1)*self.batch_size],
-                           self.y[i*self.batch_size:(i+1)*self.batch_size])
-                else:
-                    yield (i, self.x[i*self.batch_size:(i+1)*self.batch_size])
+        if self.drop_last:
+            return n_samples / self.batch_size
+        return (n_samples + self.batch_size - 1) / self.batch_size
+
+    def batch_indices(self):
+        """ Yields the rows (slice or sorted indices) of each minibatch of
+        one epoch """
+        n_batches = len(self)
+        if self.randomize and not self.block_shuffle:
+            perm = self.rng.permutation(self.x.shape[0])
+            for i in xrange(n_batches):
+                # sorted indices make the gather access memory in order
+                yield numpy.sort(perm[i*self.batch_size:(i+1)*self.batch_size])
         else:
-            for i in xrange((n_samples + self.batch_size - 1)
-                            / self.batch_size):
-                if self.y != None:
-                    yield (self.x[i*self.batch_size:(i+1)*self.batch_size],
-                           self.y[i*self.batch_size:(i+1)*self.batch_size])
-                else:
-                    yield (self.x[i*self.batch_size:(i+1)*self.batch_size])
+            if self.randomize:
+                order = self.rng.permutation(n_batches)
+            else:
+                order = xrange(n_batches)
+            for i in order:
+                yield slice(i*self.batch_size, (i+1)*self.batch_size)
+
+    def __iter__(self):
+        for rows in self.batch_indices():
+            if self.w is not None:
+                yield (self.x[rows], self.y[rows], self.w[rows])
+            elif self.y is not None:
+                yield (self.x[rows], self.y[rows])
+            else:
+                yield (self.x[rows])
+
+
+class PrefetchingIterator(object):
+    """ Prepares the next n_prefetch minibatches of a DatasetMiniBatchIterator
+    on a pool of threads while the current one is being used.
+
+    The minibatches are written in n_prefetch+1 preallocated float32 (x, w)
+    and int32 (y) buffers reused from one step to the next, so a yielded
+    minibatch is only valid until the next one is requested. If given,
+    transform(x, y) is applied in place on the buffers by the worker threads
+    (y is None for an iterator without labels), e.g. for augmentation.
+    A sparse x cannot be written in a preallocated buffer: its minibatches
+    are sliced as float32 CSR matrices by the worker threads.
+    """
+    def __init__(self, iterator, n_prefetch=2, n_threads=None, transform=None):
+        self.iterator = iterator
+        self.w = getattr(iterator, 'w', None)
+        self.n_prefetch = max(1, n_prefetch)
+        self.n_threads = n_threads or self.n_prefetch
+        self.transform = transform
+        self._sparse = sp.issparse(iterator.x)
+        shape = (iterator.batch_size,) + iterator.x.shape[1:]
+        self._x_bufs = [None if self._sparse
+                        else numpy.empty(shape, dtype='float32')
+                        for _ in xrange(self.n_prefetch + 1)]
+        self._y_bufs = None
+        if iterator.y is not None:
+            self._y_bufs = [numpy.empty((iterator.batch_size,), dtype='int32')
+                            for _ in xrange(self.n_prefetch + 1)]
+        self._w_bufs = None
+        if getattr(iterator, 'w', None) is not None:
+            self._w_bufs = [numpy.empty((iterator.batch_size,),
+                                        dtype='float32')
+                            for _ in xrange(self.n_prefetch + 1)]
+        self._pool = None
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def _take(self, a, rows, buf):
+        """ Copies a[rows] in buf without intermediate array if possible,
+        returns the number of rows copied """
+        if isinstance(rows, slice):
+            src = a[rows]
+            buf[:src.shape[0]] = src
+            return src.shape[0]
+        n = len(rows)
+        if a.dtype == buf.dtype:
+            numpy.take(a, rows, axis=0, out=buf[:n])
+        else:
+            buf[:n] = a[rows]
+        return n
+
+    def _fill(self, i, rows):
+        """ Fills the i-th buffers with the minibatch of the given rows """
+        if self._sparse:
+            self._x_bufs[i] = sp.csr_matrix(self.iterator.x[rows],
+                                                      dtype='float32')
+            n = self._x_bufs[i].shape[0]
+        else:
+            n = self._take(self.iterator.x, rows, self._x_bufs[i])
+        y = None
+        if self._y_bufs is not None:
+            self._take(self.iterator.y, rows, self._y_bufs[i])
+            y = self._y_bufs[i][:n]
+        if self._w_bufs is not None:
+            self._take(self.iterator.w, rows, self._w_bufs[i])
+        if self.transform is not None:
+            self.transform(self._x_bufs[i][:n], y)
+        return n
+
+    def _submit(self, pending, k, rows):
+        i = k % (self.n_prefetch + 1)
+        pending.append((i, self._pool.apply_async(self._fill, (i, rows))))
+
+    def __iter__(self):
+        if self._pool is None:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(self.n_threads)
+        batches = self.iterator.batch_indices()
+        pending = deque()
+        k = 0
+        for rows in batches:
+            self._submit(pending, k, rows)
+            k += 1
+            if k == self.n_prefetch:
+                break
+        while pending:
+            i, result = pending.popleft()
+            n = result.get()
+            # the buffers of the previous minibatch are free now
+            rows = next(batches, None)
+            if rows is not None:
+                self._submit(pending, k, rows)
+                k += 1
+            x = self._x_bufs[i] if self._sparse else self._x_bufs[i][:n]
+            if self._w_bufs is not None:
+                yield (x, self._y_bufs[i][:n], self._w_bufs[i][:n])
+            elif self._y_bufs is not None:
+                yield (x, self._y_bufs[i][:n])
+            else:
+                yield (x)
+
+    def close(self):
+        """ Terminates the worker threads """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+class SharedDatasetIterator(object):
+    """ Mini-batch iterator over a dataset kept in theano shared variables.
+
+    The dataset is uploaded once into shared_x (and shared_y, shared_w for
+    sample weights) and the
+    iterator yields (start, end) offsets that the compiled functions use to
+    slice minibatches inside the graph. If the dataset does not fit in
+    max_bytes, it is streamed in chunks (of a multiple of batch_size rows)
+    that replace the content of the shared variables in turn.
+    With randomize=True, the order of the chunks and of the minibatches
+    inside each chunk is shuffled at each epoch.
+    """
+    def __init__(self, x, y=None, batch_size=BATCH_SIZE,
+                 max_bytes=MAX_SHARED_BYTES, randomize=False, random_state=42,
+                 w=None):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.batch_size = batch_size
+        self.randomize = randomize
+        from sklearn.utils import check_random_state
+        self.rng = check_random_state(random_state)
+        self.n_samples = x.shape[0]
+        if sp.issparse(x):  # data and indices of CSR rows
+            row_bytes = max(1, 8 * x.nnz / max(1, self.n_samples))
+        else:
+            row_bytes = max(1, x.shape[1] * numpy.dtype('float32').itemsize)
+        chunk_batches = max(1, max_bytes / (row_bytes * batch_size))
+        self.chunk_size = min(self.n_samples, chunk_batches * batch_size)
+        self.n_chunks = (self.n_samples + self.chunk_size - 1) / self.chunk_size
+        self.shared_x = shared(self._chunk(x, 0, 'float32'),
+                name='shared_x', borrow=True)
+        self.shared_y = None
+        if y is not None:
+            self.shared_y = shared(self._chunk(y, 0, 'int32'),
+                    name='shared_y', borrow=True)
+        self.shared_w = None
+        if w is not None:
+            self.shared_w = shared(self._chunk(w, 0, 'float32'),
+                    name='shared_w', borrow=True)
+        self._loaded = 0  # index of the chunk currently in shared_x/y/w
+
+    def _chunk(self, a, i, dtype):
+        if sp.issparse(a):
+            return sp.csr_matrix(
+                    a[i*self.chunk_size:(i+1)*self.chunk_size], dtype=dtype)
+        return numpy.asarray(a[i*self.chunk_size:(i+1)*self.chunk_size],
+                dtype=dtype)
+
+    def _load(self, i):
+        """ Uploads the i-th chunk of the dataset in the shared variables """
+        if i != self._loaded:
+            self.shared_x.set_value(self._chunk(self.x, i, 'float32'),
+                    borrow=True)
+            if self.y is not None:
+                self.shared_y.set_value(self._chunk(self.y, i, 'int32'),
+                        borrow=True)
+            if self.w is not None:
+                self.shared_w.set_value(self._chunk(self.w, i, 'float32'),
+                        borrow=True)
+            self._loaded = i
+
+    def __iter__(self):
+        chunks = xrange(self.n_chunks)
+        if self.randomize:
+            # start with the loaded chunk to avoid an upload
+            chunks = self.rng.permutation(self.n_chunks)
+            chunks = numpy.roll(chunks,
+                                -numpy.flatnonzero(chunks == self._loaded)[0])
+        for c in chunks:
+            self._load(c)
+            n = min(self.chunk_size, self.n_samples - c*self.chunk_size)
+            starts = xrange(0, n, self.batch_size)
+            if self.randomize:
+                starts = self.rng.permutation(starts)
+            for start in starts:
+                yield (start, min(start + self.batch_size, n))
 
 
 class LogisticRegression:
@@ -120,20 +383,25 @@ class LogisticRegression:
         else:
             self.b = build_shared_zeros((n_out,), 'b')
         self.input = input
-        self.p_y_given_x = T.nnet.softmax(T.dot(self.input, self.W) + self.b)
+        self.p_y_given_x = T.nnet.softmax(dot(self.input, self.W) + self.b)
         self.y_pred = T.argmax(self.p_y_given_x, axis=1)
         self.output = self.y_pred
         self.params = [self.W, self.b]
 
-    def negative_log_likelihood(self, y):
+    def negative_log_likelihood(self, y, w=None):
+        """ Mean negative log-likelihood, weighted by the sample weights w
+        if given """
+        if w is not None:
+            return -(T.sum(w * T.log(self.p_y_given_x)[T.arange(y.shape[0]), y])
+                     / T.sum(w))
         return -T.mean(T.log(self.p_y_given_x)[T.arange(y.shape[0]), y])
 
     def negative_log_likelihood_sum(self, y):
         return -T.sum(T.log(self.p_y_given_x)[T.arange(y.shape[0]), y])
 
-    def training_cost(self, y):
+    def training_cost(self, y, w=None):
         """ Wrapper for standard name """
-        return self.negative_log_likelihood(y)
+        return self.negative_log_likelihood(y, w)
 
     def errors(self, y):
         if y.ndim != self.y_pred.ndim:
@@ -155,63 +423,122 @@ class NeuralNet(object):
                  n_outs=62*3,
                  rho=0.95, eps=1.E-6,
                  momentum=0.9, step_adapt_alpha=1.E-4,
-                 debugprint=False):
+                 debugprint=False, sparse_input=False):
         """
         Basic Neural Net class
+
+        With sparse_input=True, x is a CSR matrix (scipy.sparse minibatches)
+        and the first layer uses a structured dot.
+
+        The theano graph is built (see _build) on first use of one of its
+        attributes, typically by the first fit or predict.
         """
-        self.layers = []
-        self.params = []
         self.n_layers = len(layers_types)
         self.layers_types = layers_types
         assert self.n_layers > 0
         self._rho = rho  # ``momentum'' for adadelta (and discount/decay for RMSprop)
         self._eps = eps  # epsilon for adadelta (and for RMSprop)
         self._momentum = momentum  # for RMSProp
+        # optimizers states, allocated by the trainers (see _optimizer_state)
         self._accugrads = []  # for adadelta
         self._accudeltas = []  # for adadelta
         self._avggrads = []  # for RMSprop in the Alex Graves' variant
         self._stepadapts = []  # for RMSprop with step adaptations
         self._stepadapt_alpha = step_adapt_alpha
+        self._optimizer_method = None  # method the states were trained with
+        self._compiled = {}  # cache of compiled functions, see _function()
+        self._compiled_arch = None  # architecture the cache was built for
+        self._numpy_rng = numpy_rng
+        self._theano_rng = theano_rng
+        self._debugprint = debugprint
+        self._sparse_input = sparse_input
+        self._built = False
 
-        if theano_rng == None:
-            theano_rng = RandomStreams(numpy_rng.randint(2 ** 30))
-
-        self.x = T.fmatrix('x')
-        self.y = T.ivector('y')
-        
         self.layers_ins = [n_ins] + layers_sizes
         self.layers_outs = layers_sizes + [n_outs]
+
+    # attributes set by _build()
+    _GRAPH_ATTRIBUTES = frozenset(['layers', 'params', 'x', 'y', 'w',
+        'mean_cost', 'weighted_mean_cost', 'cost', 'errors', 'y_pred',
+        'p_y_given_x', 'sum_cost', 'sum_errors', 'training_errors'])
+
+    def __getattr__(self, name):
+        """ Builds the graph on first access to one of its attributes """
+        if (name in NeuralNet._GRAPH_ATTRIBUTES
+                and not self.__dict__.get('_built', True)):
+            self._built = True
+            self._build()
+            return getattr(self, name)
+        raise AttributeError("'%s' object has no attribute '%s'"
+                             % (type(self).__name__, name))
+
+    def _build(self):
+        """ Builds the layers, costs and predictions theano graph """
+        numpy_rng = self._numpy_rng
+        if self._theano_rng == None:
+            self._theano_rng = T.shared_randomstreams.RandomStreams(
+                    numpy_rng.randint(2 ** 30))
+
+        self.layers = []
+        self.params = []
+        if self._sparse_input:
+            self.x = S.csr_matrix('x', dtype='float32')
+        else:
+            self.x = T.fmatrix('x')
+        self.y = T.ivector('y')
+        self.w = T.fvector('w')  # sample weights
+        # (output, input) of the dropouts of the training graph
+        self._dropouts = []
         
         layer_input = self.x
         
-        for layer_type, n_in, n_out in zip(layers_types,
-                self.layers_ins, self.layers_outs):
+        for i, (layer_type, n_in, n_out) in enumerate(zip(self.layers_types,
+                self.layers_ins, self.layers_outs)):
             this_layer = layer_type(rng=numpy_rng,
-                    input=layer_input, n_in=n_in, n_out=n_out)
+                    input=self._layer_input(layer_input, i),
+                    n_in=n_in, n_out=n_out)
             assert hasattr(this_layer, 'output')
             self.params.extend(this_layer.params)
-            self._accugrads.extend([build_shared_zeros(t.shape.eval(),
-                'accugrad') for t in this_layer.params])
-            self._accudeltas.extend([build_shared_zeros(t.shape.eval(),
-                'accudelta') for t in this_layer.params])
-            self._avggrads.extend([build_shared_zeros(t.shape.eval(),
-                'avggrad') for t in this_layer.params])
-            self._stepadapts.extend([shared(value=numpy.ones(t.shape.eval(),
-                dtype=theano.config.floatX),
-                name='stepadapt', borrow=True) for t in this_layer.params])
             self.layers.append(this_layer)
             layer_input = this_layer.output
 
         assert hasattr(self.layers[-1], 'training_cost')
         assert hasattr(self.layers[-1], 'errors')
         self.mean_cost = self.layers[-1].negative_log_likelihood(self.y)
+        self.weighted_mean_cost = self.layers[-1].negative_log_likelihood(
+                self.y, self.w)
         self.cost = self.layers[-1].training_cost(self.y)
-        if debugprint:
+        if self._debugprint:
             theano.printing.debugprint(self.cost)
 
-        self.errors = self.layers[-1].errors(self.y)
-        self.y_pred = self.layers[-1].y_pred
-        self.p_y_given_x = self.layers[-1].p_y_given_x
+        # errors of the training graph, output by the trainers
+        self.training_errors = T.sum(T.neq(self.layers[-1].y_pred, self.y))
+        # the inference outputs, without dropout (the sums over a minibatch
+        # are for the evaluation, see evaluate())
+        self.errors, self.y_pred, self.p_y_given_x, self.sum_cost = \
+                self._without_dropout([self.layers[-1].errors(self.y),
+                    self.layers[-1].y_pred, self.layers[-1].p_y_given_x,
+                    self.layers[-1].negative_log_likelihood_sum(self.y)])
+        self.sum_errors = T.sum(T.neq(self.y_pred, self.y))
+
+    def _without_dropout(self, outputs):
+        """ Copies of the outputs where the dropouts (see _layer_input) are
+        replaced by their inputs, so that the inference functions draw no
+        random mask. One at a time, as the input of a dropout can depend on
+        another one. """
+        dropouts = list(self._dropouts)
+        while dropouts:
+            (dropped, x), dropouts = dropouts[0], dropouts[1:]
+            n = len(outputs)
+            cloned = theano.clone(outputs + [v for d in dropouts for v in d],
+                                  replace={dropped: x})
+            outputs = cloned[:n]
+            dropouts = zip(cloned[n::2], cloned[n+1::2])
+        return outputs
+
+    def _layer_input(self, x, i):
+        """ Input of the i-th layer from the output x of the previous one """
+        return x
 
     def __repr__(self):
         dimensions_layers_str = map(lambda x: "x".join(map(str, x)),
@@ -219,59 +546,126 @@ class NeuralNet(object):
         return "_".join(map(lambda x: "_".join((x[0].__name__, x[1])),
                             zip(self.layers_types, dimensions_layers_str)))
 
-
-    def get_SGD_trainer(self):
-        """ Returns a plain SGD minibatch trainer with learning rate as param. """
-        batch_x = T.fmatrix('batch_x')
+    def get_config(self):
+        """ Arguments of the constructor to rebuild this net (see save_model)
+        """
+        return {'n_ins': self.layers_ins[0],
+                'layers_types': [t.__name__ for t in self.layers_types],
+                'layers_sizes': self.layers_ins[1:],
+                'n_outs': self.layers_outs[-1],
+                'rho': self._rho, 'eps': self._eps,
+                'momentum': self._momentum,
+                'step_adapt_alpha': self._stepadapt_alpha,
+                'sparse_input': self._sparse_input}
+
+    def _optimizer_state(self, name, init=0.):
+        """ Returns the optimizer state list self.<name> of one shared
+        variable per parameter, allocating it (filled with init) on first
+        use so that only the states of the trainers in use take memory. """
+        states = getattr(self, name)
+        if not states:
+            for param in self.params:
+                value = param.get_value(borrow=True)
+                states.append(shared(value=numpy.full(value.shape, init,
+                                                      dtype=value.dtype),
+                                     name=name.strip('_')[:-1], borrow=True))
+        return states
+
+    def snapshot_params(self, buffers=None):
+        """ Copies the values of the parameters in the numpy buffers (which
+        are allocated if None) and returns them """
+        if buffers is None:
+            buffers = [numpy.empty_like(param.get_value(borrow=True))
+                       for param in self.params]
+        for buf, param in zip(buffers, self.params):
+            numpy.copyto(buf, param.get_value(borrow=True))
+        return buffers
+
+    def restore_params(self, buffers):
+        """ Sets the values of the parameters from copies of the buffers """
+        for buf, param in zip(buffers, self.params):
+            param.set_value(buf, borrow=False)
+
+    def _x_dtype(self, given_set=None):
+        """ dtype of the minibatches of x yielded by given_set """
+        return str(getattr(getattr(given_set, 'x', None), 'dtype',
+                           self.x.dtype))
+
+    def _weighted(self, given_set=None):
+        """ Whether given_set yields sample weights """
+        return getattr(given_set, 'w', None) is not None
+
+    def _train_cost(self, given_set=None):
+        """ The cost to train on given_set, weighted if it has weights """
+        if self._weighted(given_set):
+            return self.weighted_mean_cost
+        return self.mean_cost
+
+    def _batch_inputs(self, given_set=None, with_y=True, with_w=False):
+        """ Returns the (inputs, givens) to compile a function on minibatches.
+
+        With a SharedDatasetIterator as given_set, the inputs are the (start,
+        end) offsets of the minibatch in its shared variables, otherwise they
+        are the minibatch (batch_x, batch_y[, batch_w]) itself, batch_x being
+        of the dtype of given_set.x.
+        """
+        if isinstance(given_set, SharedDatasetIterator):
+            start = T.lscalar('start')
+            end = T.lscalar('end')
+            givens = {self.x: given_set.shared_x[start:end]}
+            if with_y:
+                givens[self.y] = given_set.shared_y[start:end]
+            if with_w:
+                givens[self.w] = given_set.shared_w[start:end]
+            return [theano.Param(start), theano.Param(end)], givens
+        x_dtype = self._x_dtype(given_set)
         batch_y = T.ivector('batch_y')
-        learning_rate = T.fscalar('lr')  # learning rate
-        gparams = T.grad(self.mean_cost, self.params)  # all the gradients
+        if isinstance(self.x.type, S.SparseType):
+            batch_x = S.csr_matrix('batch_x', dtype=x_dtype)
+            cast = S.cast
+        else:
+            batch_x = T.matrix('batch_x', dtype=x_dtype)
+            cast = T.cast
+        if x_dtype == self.x.dtype:
+            givens = {self.x: batch_x}
+        else:  # cast inside the graph rather than copying the input
+            givens = {self.x: cast(batch_x, self.x.dtype)}
+        inputs = [theano.Param(batch_x)]
+        if with_y:
+            givens[self.y] = batch_y
+            inputs.append(theano.Param(batch_y))
+        if with_w:
+            batch_w = T.fvector('batch_w')
+            givens[self.w] = batch_w
+            inputs.append(theano.Param(batch_w))
+        return inputs, givens
+
+    def _sgd_updates(self, gparams, learning_rate):
+        """ Plain SGD updates of the parameters for their gradients gparams """
         updates = OrderedDict()
         for param, gparam in zip(self.params, gparams):
             updates[param] = param - gparam * learning_rate
+        return self._regularize(updates, learning_rate)
 
-        train_fn = theano.function(inputs=[theano.Param(batch_x),
-                                           theano.Param(batch_y),
-                                           theano.Param(learning_rate)],
-                                   outputs=self.mean_cost,
-                                   updates=updates,
-                                   givens={self.x: batch_x, self.y: batch_y})
-
-        return train_fn
-
-    def get_adagrad_trainer(self):
-        """ Returns an Adagrad (Duchi et al. 2010) trainer using a learning rate.
-        """
-        batch_x = T.fmatrix('batch_x')
-        batch_y = T.ivector('batch_y')
-        learning_rate = T.fscalar('lr')  # learning rate
-        gparams = T.grad(self.mean_cost, self.params)  # all the gradients
+    def _adagrad_updates(self, gparams, learning_rate):
+        """ Adagrad (Duchi et al. 2010) updates for the gradients gparams """
         updates = OrderedDict()
-        for accugrad, param, gparam in zip(self._accugrads, self.params, gparams):
+        for accugrad, param, gparam in zip(self._optimizer_state('_accugrads'),
+                                           self.params, gparams):
             # c.f. Algorithm 1 in the Adadelta paper (Zeiler 2012)
             agrad = accugrad + gparam * gparam
             dx = - (learning_rate / T.sqrt(agrad + self._eps)) * gparam
             updates[param] = param + dx
             updates[accugrad] = agrad
+        return self._regularize(updates, learning_rate)
 
-        train_fn = theano.function(inputs=[theano.Param(batch_x), 
-            theano.Param(batch_y),
-            theano.Param(learning_rate)],
-            outputs=self.mean_cost,
-            updates=updates,
-            givens={self.x: batch_x, self.y: batch_y})
-
-        return train_fn
-
-    def get_adadelta_trainer(self):
-        """ Returns an Adadelta (Zeiler 2012) trainer using self._rho and
-        self._eps params. """
-        batch_x = T.fmatrix('batch_x')
-        batch_y = T.ivector('batch_y')
-        gparams = T.grad(self.mean_cost, self.params)
+    def _adadelta_updates(self, gparams):
+        """ Adadelta (Zeiler 2012) updates for the gradients gparams, using
+        self._rho and self._eps """
         updates = OrderedDict()
-        for accugrad, accudelta, param, gparam in zip(self._accugrads,
-                self._accudeltas, self.params, gparams):
+        for accugrad, accudelta, param, gparam in zip(
+                self._optimizer_state('_accugrads'),
+                self._optimizer_state('_accudeltas'), self.params, gparams):
             # c.f. Algorithm 1 in the Adadelta paper (Zeiler 2012)
             agrad = self._rho * accugrad + (1 - self._rho) * gparam * gparam
             dx = - T.sqrt((accudelta + self._eps)
@@ -280,47 +674,387 @@ class NeuralNet(object):
                                   + (1 - self._rho) * dx * dx)
             updates[param] = param + dx
             updates[accugrad] = agrad
+        # adadelta has no learning rate: regularization steps of INIT_LR
+        return self._regularize(updates, numpy.float32(INIT_LR))
+
+    def _rmsprop_updates(self, gparams, learning_rate, with_step_adapt=False,
+                         nesterov=False):
+        """ RMSprop (Graves 2013) updates for the gradients gparams, see
+        get_rmsprop_trainer """
+        updates = OrderedDict()
+        for accugrad, avggrad, accudelta, stepadapt, param, gparam in zip(
+                self._optimizer_state('_accugrads'),
+                self._optimizer_state('_avggrads'),
+                self._optimizer_state('_accudeltas'),
+                self._optimizer_state('_stepadapts', init=1.),
+                self.params, gparams):
+            agrad = self._rho * accugrad + (1 - self._rho) * gparam * gparam
+            mgrad = self._rho * avggrad + (1 - self._rho) * gparam
+            step = - learning_rate * gparam / T.sqrt(agrad - mgrad * mgrad
+                                                     + self._eps)
+            if with_step_adapt:
+                gain = T.switch(T.gt(step * accudelta, 0),
+                                stepadapt * (1 + self._stepadapt_alpha),
+                                stepadapt * (1 - self._stepadapt_alpha))
+                step = gain * step
+                updates[stepadapt] = gain
+            dx = self._momentum * accudelta + step
+            if nesterov:
+                updates[param] = param + self._momentum * dx + step
+            else:
+                updates[param] = param + dx
+            updates[accugrad] = agrad
+            updates[avggrad] = mgrad
+            updates[accudelta] = dx
+        return self._regularize(updates, learning_rate)
+
+    def _regularize(self, updates, learning_rate):
+        """ Adds the regularization of the parameters to their updates (none
+        for this class, see RegularizedNet) """
+        return updates
+
+    def _updates(self, method, gparams, learning_rate=None):
+        """ Updates of the training method ('sgd', 'adagrad', 'adadelta' or
+        'rmsprop', with step adaptation, as used by fit) """
+        if method == 'sgd':
+            return self._sgd_updates(gparams, learning_rate)
+        elif method == 'adagrad':
+            return self._adagrad_updates(gparams, learning_rate)
+        elif method == 'adadelta':
+            return self._adadelta_updates(gparams)
+        elif method == 'rmsprop':
+            return self._rmsprop_updates(gparams, learning_rate,
+                                         with_step_adapt=True)
+        raise ValueError("unknown training method: %s" % method)
+
+    def get_SGD_trainer(self, given_set=None, profile=False):
+        """ Returns a plain SGD minibatch trainer with learning rate as param.
+        With profile=True, theano profiles it (see train_fn.profile). """
+        inputs, givens = self._batch_inputs(given_set,
+                with_w=self._weighted(given_set))
+        cost = self._train_cost(given_set)
+        learning_rate = T.fscalar('lr')  # learning rate
+        gparams = T.grad(cost, self.params)  # all the gradients
+        updates = self._sgd_updates(gparams, learning_rate)
+
+        train_fn = theano.function(inputs=inputs + [theano.Param(learning_rate)],
+                                   outputs=[cost, self.training_errors],
+                                   updates=updates,
+                                   givens=givens,
+                                   profile=profile)
+
+        return train_fn
 
-        train_fn = theano.function(inputs=[theano.Param(batch_x),
-                                           theano.Param(batch_y)],
-                                   outputs=self.mean_cost,
+    def get_adagrad_trainer(self, given_set=None, profile=False):
+        """ Returns an Adagrad (Duchi et al. 2010) trainer using a learning rate.
+        """
+        inputs, givens = self._batch_inputs(given_set,
+                with_w=self._weighted(given_set))
+        cost = self._train_cost(given_set)
+        learning_rate = T.fscalar('lr')  # learning rate
+        gparams = T.grad(cost, self.params)  # all the gradients
+        updates = self._adagrad_updates(gparams, learning_rate)
+
+        train_fn = theano.function(inputs=inputs + [theano.Param(learning_rate)],
+            outputs=[cost, self.training_errors],
+            updates=updates,
+            givens=givens,
+            profile=profile)
+
+        return train_fn
+
+    def get_adadelta_trainer(self, given_set=None, profile=False):
+        """ Returns an Adadelta (Zeiler 2012) trainer using self._rho and
+        self._eps params. """
+        inputs, givens = self._batch_inputs(given_set,
+                with_w=self._weighted(given_set))
+        cost = self._train_cost(given_set)
+        gparams = T.grad(cost, self.params)
+        updates = self._adadelta_updates(gparams)
+
+        train_fn = theano.function(inputs=inputs,
+                                   outputs=[cost, self.training_errors],
                                    updates=updates,
-                                   givens={self.x: batch_x, self.y: batch_y})
+                                   givens=givens,
+                                   profile=profile)
 
         return train_fn
 
+    def get_rmsprop_trainer(self, given_set=None, with_step_adapt=False,
+                            nesterov=False, profile=False):
+        """ Returns an RMSprop (Graves 2013) trainer using a learning rate,
+        self._rho, self._eps and self._momentum params.
+
+        The gradients are normalized by the running estimate of their
+        standard deviation. With step adaptation, each parameter has a gain
+        (in self._stepadapts) multiplied by (1 +/- self._stepadapt_alpha)
+        when the step goes in the same/opposite direction as the previous
+        one. With nesterov=True, the momentum is applied as Nesterov's
+        accelerated gradient (Sutskever et al. 2013 reformulation).
+        """
+        inputs, givens = self._batch_inputs(given_set,
+                with_w=self._weighted(given_set))
+        cost = self._train_cost(given_set)
+        learning_rate = T.fscalar('lr')  # learning rate
+        gparams = T.grad(cost, self.params)
+        updates = self._rmsprop_updates(gparams, learning_rate,
+                with_step_adapt=with_step_adapt, nesterov=nesterov)
+
+        train_fn = theano.function(inputs=inputs + [theano.Param(learning_rate)],
+                                   outputs=[cost, self.training_errors],
+                                   updates=updates,
+                                   givens=givens,
+                                   profile=profile)
+
+        return train_fn
+
+    def get_trainer(self, method='adadelta', given_set=None, profile=False):
+        """ Returns the trainer of method ('sgd', 'adagrad', 'adadelta' or
+        'rmsprop', with step adaptation) for the minibatches of given_set.
+        Trainers on plain minibatches are cached per (method, input dtype,
+        weighting) as the functions of _function(), so that they are
+        compiled once for all the fit and partial_fit calls (and again when
+        the repr changes, e.g. with the L1_reg/L2_reg of a RegularizedNet).
+        """
+        getters = {'sgd': self.get_SGD_trainer,
+                   'adagrad': self.get_adagrad_trainer,
+                   'adadelta': self.get_adadelta_trainer,
+                   'rmsprop': lambda given_set, profile:
+                       self.get_rmsprop_trainer(given_set,
+                           with_step_adapt=True, profile=profile)}
+        if method not in getters:
+            raise ValueError("unknown training method: %s" % method)
+        if profile or isinstance(given_set, SharedDatasetIterator):
+            return getters[method](given_set, profile=profile)
+        arch = repr(self)
+        if arch != self._compiled_arch:
+            self._compiled = {}
+            self._compiled_arch = arch
+        key = ('train', method, self._x_dtype(given_set),
+               self._weighted(given_set))
+        if key not in self._compiled:
+            self._compiled[key] = getters[method](given_set, profile=False)
+        return self._compiled[key]
+
+    def reset_optimizer_state(self):
+        """ Resets the allocated optimizer states to their initial values """
+        for name in OPTIMIZER_STATES:
+            for state in getattr(self, name):
+                value = state.get_value(borrow=True)
+                state.set_value(numpy.full(value.shape,
+                    1. if name == '_stepadapts' else 0., dtype=value.dtype),
+                    borrow=True)
+
+    def _start_training(self, method, warm_start=True):
+        """ Resets the optimizer state unless warm_start, and if it was
+        trained by another method (as the methods share states) """
+        if not warm_start or self._optimizer_method not in (None, method):
+            self.reset_optimizer_state()
+        self._optimizer_method = method
+
+    def partial_fit(self, x, y=None, sample_weight=None, class_weight=None,
+                    method='adadelta', learning_rate=INIT_LR,
+                    batch_size=BATCH_SIZE):
+        """ One pass of training on new data, continuing from the current
+        parameters and optimizer state with the cached trainer (see
+        get_trainer). x and y are arrays (e.g. the tail of a memmap) cut in
+        minibatches of batch_size, or, if y is None, x is an iterable of
+        (x, y) or (x, y, w) minibatches (e.g. a generator), whose sample
+        weights are then given by w and a class_weight dict. Returns self.
+        """
+        if y is not None:
+            w = None
+            if class_weight is not None or sample_weight is not None:
+                w = sample_weights(y, class_weight, sample_weight)
+            batches = DatasetMiniBatchIterator(x, numpy.asarray(y,
+                dtype='int32'), batch_size=batch_size, w=w)
+            given_set = batches
+        else:
+            import itertools
+            if sample_weight is not None:
+                raise ValueError("the sample weights of minibatches are "
+                                 "given as their w, not sample_weight")
+            if class_weight == 'balanced':
+                raise ValueError("class_weight='balanced' needs the class "
+                                 "frequencies of the whole set, give a "
+                                 "{class: weight} dict for minibatches")
+            batches = iter(x)
+            if class_weight is not None:
+                batches = ((b[0], b[1], sample_weights(
+                            numpy.asarray(b[1], dtype='int32'), class_weight,
+                            b[2] if len(b) > 2 else None))
+                           for b in batches)
+            first = next(batches, None)
+            if first is None:
+                return self
+            given_set = DatasetMiniBatchIterator(*first[:2],
+                    w=first[2] if len(first) > 2 else None)
+            batches = itertools.chain([first], batches)
+        train_fn = self.get_trainer(method, given_set)
+        self._start_training(method)
+        lr = [] if method == 'adadelta' else [numpy.float32(learning_rate)]
+        for batch in batches:
+            batch = [batch[0], numpy.asarray(batch[1], dtype='int32')] + \
+                    [numpy.asarray(b, dtype='float32') for b in batch[2:]]
+            train_fn(*(batch + lr))
+        return self
+
+    def get_gradient_fn(self, given_set=None):
+        """ Returns a function of a minibatch computing the cost, the
+        training errors and the gradients of the parameters, without
+        updating them (for data-parallel training, see parallel.py). """
+        inputs, givens = self._batch_inputs(given_set,
+                with_w=self._weighted(given_set))
+        cost = self._train_cost(given_set)
+        gparams = T.grad(cost, self.params)
+        return theano.function(inputs=inputs,
+                               outputs=[cost, self.training_errors] + gparams,
+                               givens=givens)
+
+    def get_apply_gradients_fn(self, method='adadelta'):
+        """ Returns a function applying the update rule of method (see
+        _updates) to gradients given as inputs: one array per parameter,
+        then the learning rate (except for adadelta). """
+        gparams = [param.type('g_' + str(param)) for param in self.params]
+        inputs = list(gparams)
+        learning_rate = None
+        if method != 'adadelta':
+            learning_rate = T.fscalar('lr')
+            inputs.append(learning_rate)
+        return theano.function(inputs=inputs, outputs=[],
+                updates=self._updates(method, gparams, learning_rate))
+
+    def _function(self, kind, given_set=None):
+        """ Returns the compiled 'score', 'predict', 'predict_proba',
+        'evaluate' (summed cost and errors, predictions and probabilities)
+        or 'evaluate_x' (predictions and probabilities) function for the
+        minibatches of given_set.
+
+        Functions on plain minibatches are cached per (kind, input dtype), the
+        cache being emptied when the architecture (repr) of the net changes.
+        Functions bound to the shared variables of a SharedDatasetIterator
+        are not cached, so that they do not keep the dataset alive.
+        """
+        with_y = kind in ('score', 'evaluate')
+        outputs = {'score': self.errors,
+                   'predict': self.y_pred,
+                   'predict_proba': self.p_y_given_x,
+                   'evaluate': [self.sum_cost, self.sum_errors,
+                                self.y_pred, self.p_y_given_x],
+                   'evaluate_x': [self.y_pred, self.p_y_given_x]}[kind]
+        if isinstance(given_set, SharedDatasetIterator):
+            inputs, givens = self._batch_inputs(given_set, with_y=with_y)
+            return theano.function(inputs=inputs, outputs=outputs,
+                                   givens=givens)
+        arch = repr(self)
+        if arch != self._compiled_arch:
+            self._compiled = {}
+            self._compiled_arch = arch
+        x_dtype = self._x_dtype(given_set)
+        key = (kind, x_dtype)
+        if key not in self._compiled:
+            inputs, givens = self._batch_inputs(given_set, with_y=with_y)
+            self._compiled[key] = theano.function(inputs=inputs,
+                                                  outputs=outputs,
+                                                  givens=givens)
+        return self._compiled[key]
+
+    def warmup(self, dtypes=('float32',)):
+        """ Precompiles the evaluation functions for inputs of the given
+        dtypes, so that the first call does not compile.
+        """
+        for dtype in dtypes:
+            given_set = DatasetMiniBatchIterator(numpy.zeros((0, 0),
+                                                             dtype=dtype))
+            for kind in ('evaluate', 'evaluate_x'):
+                self._function(kind, given_set)
+        return self
+
+    def evaluate(self, given_set, fn=None):
+        """ Evaluates the net on given_set in one sweep of a single compiled
+        function. Returns a dict of the predictions 'y_pred' and
+        probabilities 'p_y_given_x' of all the samples (in the order of
+        given_set.x) and, if given_set has targets, of the mean 'cost'
+        (negative log-likelihood) and 'error' rate.
+        fn is the 'evaluate' (or 'evaluate_x') function of given_set if
+        already compiled (see _function), e.g. for a SharedDatasetIterator
+        evaluated repeatedly.
+        """
+        labeled = given_set.y is not None
+        if fn is None:
+            fn = self._function('evaluate' if labeled else 'evaluate_x',
+                                given_set)
+        n_samples = given_set.x.shape[0]
+        y_pred = numpy.empty((n_samples,), dtype=self.y_pred.dtype)
+        p_y_given_x = numpy.empty((n_samples, self.layers_outs[-1]),
+                                  dtype=self.p_y_given_x.dtype)
+        sum_cost = 0.
+        sum_errors = 0
+        if isinstance(given_set, SharedDatasetIterator):
+            def batches():
+                for start, end in given_set:
+                    offset = given_set._loaded * given_set.chunk_size
+                    yield (slice(offset + start, offset + end),
+                           fn(start, end))
+        elif labeled:
+            def batches():
+                for rows in given_set.batch_indices():
+                    yield rows, fn(given_set.x[rows], given_set.y[rows])
+        else:
+            def batches():
+                for rows in given_set.batch_indices():
+                    yield rows, fn(given_set.x[rows])
+        for rows, outputs in batches():
+            if labeled:
+                batch_cost, batch_errors, y_pred[rows], p_y_given_x[rows] = \
+                        outputs
+                sum_cost += batch_cost
+                sum_errors += batch_errors
+            else:
+                y_pred[rows], p_y_given_x[rows] = outputs
+        results = {'y_pred': y_pred, 'p_y_given_x': p_y_given_x}
+        if labeled:
+            results['cost'] = sum_cost / max(1, n_samples)
+            results['error'] = float(sum_errors) / max(1, n_samples)
+        return results
+
     def score_classif(self, given_set):
         """ Returns functions to get current classification errors. """
-        batch_x = T.fmatrix('batch_x')
-        batch_y = T.ivector('batch_y')
-        score = theano.function(inputs=[theano.Param(batch_x),
-                                        theano.Param(batch_y)],
-                                outputs=self.errors,
-                                givens={self.x: batch_x, self.y: batch_y})
-
-        def scoref():
-            """ returned function that scans the entire set given as input """
-            return [score(batch_x, batch_y) for batch_x, batch_y in given_set]
+        score = self._function('score', given_set)
+
+        if self._weighted(given_set) and not isinstance(given_set,
+                                                        SharedDatasetIterator):
+            def scoref():
+                """ returned function that scans the entire set given as
+                input, its sample weights are not used """
+                return [score(x, y) for x, y, _ in given_set]
+        else:
+            def scoref():
+                """ returned function that scans the entire set given as
+                input """
+                return [score(*batch) for batch in given_set]
 
         return scoref
 
     def predict_(self, given_set):
-        batch_x = T.fmatrix('batch_x')
-        pred = theano.function(inputs=[theano.Param(batch_x)],
-                                outputs=self.y_pred,
-                                givens={self.x: batch_x})
-        def predictf():
-            return [pred(batch_x) for batch_x in given_set]
+        pred = self._function('predict', given_set)
+        if isinstance(given_set, SharedDatasetIterator):
+            def predictf():
+                return [pred(start, end) for start, end in given_set]
+        else:
+            def predictf():
+                return [pred(batch_x) for batch_x in given_set]
 
         return predictf
 
     def predict_proba_(self, given_set):
-        batch_x = T.fmatrix('batch_x')
-        pred_prob = theano.function(inputs=[theano.Param(batch_x)],
-                                outputs=self.p_y_given_x,
-                                givens={self.x: batch_x})
-        def predict_probf():
-            return [pred_prob(batch_x) for batch_x in given_set]
+        pred_prob = self._function('predict_proba', given_set)
+        if isinstance(given_set, SharedDatasetIterator):
+            def predict_probf():
+                return [pred_prob(start, end) for start, end in given_set]
+        else:
+            def predict_probf():
+                return [pred_prob(batch_x) for batch_x in given_set]
 
         return predict_probf
 
@@ -335,25 +1069,47 @@ class RegularizedNet(NeuralNet):
                  rho=0.95, eps=1.E-6,
                  L1_reg=0.1,
                  L2_reg=0.1,
-                 debugprint=False):
+                 debugprint=False, sparse_input=False):
         """
         A deep neural net with possible L1 and/or L2 regularization.
+
+        The regularization is applied by the trainers to the updates of the
+        weights (see _regularize), not added to the cost.
         """
         super(RegularizedNet, self).__init__(numpy_rng, theano_rng, n_ins,
-                layers_types, layers_sizes, n_outs, rho, eps, debugprint)
+                layers_types, layers_sizes, n_outs, rho, eps,
+                debugprint=debugprint, sparse_input=sparse_input)
 
         self.L1_reg = L1_reg
         self.L2_reg = L2_reg
-        L1 = shared(0.)
-        for param in self.params:
-            L1 += T.sum(abs(param))
-        if L1_reg > 0.:
-            self.cost = self.cost + L1_reg * L1
-        L2 = shared(0.)
-        for param in self.params:
-            L2 += T.sum(param ** 2)
-        if L2_reg > 0.:
-            self.cost = self.cost + L2_reg * L2
+
+    def _regularize(self, updates, learning_rate):
+        """ L2 as weight decay and L1 as a proximal (soft thresholding) step
+        on the updated weights, of learning_rate * L2_reg and learning_rate
+        * L1_reg, in float32. The biases are not regularized. """
+        for layer in self.layers:
+            W = layer.W
+            new_W = updates[W]
+            if self.L2_reg > 0.:
+                new_W = new_W - (learning_rate
+                                 * numpy.float32(self.L2_reg)) * W
+            if self.L1_reg > 0.:
+                threshold = learning_rate * numpy.float32(self.L1_reg)
+                new_W = T.sgn(new_W) * T.maximum(abs(new_W) - threshold, 0)
+            updates[W] = T.cast(new_W, W.dtype)
+        return updates
+
+    def __repr__(self):
+        # the trainers compiled (and cached, see get_trainer) depend on them
+        return super(RegularizedNet, self).__repr__() + "\n"\
+                + "L1_reg: " + str(self.L1_reg) + ", L2_reg: "\
+                + str(self.L2_reg)
+
+    def get_config(self):
+        config = super(RegularizedNet, self).get_config()
+        del config['momentum'], config['step_adapt_alpha']
+        config.update(L1_reg=self.L1_reg, L2_reg=self.L2_reg)
+        return config
 
 
 class DropoutNet(NeuralNet):
@@ -365,51 +1121,166 @@ class DropoutNet(NeuralNet):
                  dropout_rates=[0.2, 0.5, 0.5, 0.5, 0.5],
                  n_outs=62 * 3,
                  rho=0.98, eps=1.E-6,
-                 debugprint=False):
+                 debugprint=False, sparse_input=False):
         """
         A dropout-regularized neural net.
+
+        dropout_rates[i] is the dropout rate of the input of the i-th layer.
         """
         super(DropoutNet, self).__init__(numpy_rng, theano_rng, n_ins,
-                layers_types, layers_sizes, n_outs, rho, eps, debugprint)
+                layers_types, layers_sizes, n_outs, rho, eps,
+                debugprint=debugprint, sparse_input=sparse_input)
 
         self.dropout_rates = dropout_rates
-        dropout_layer_input = dropout(numpy_rng, self.x, p=dropout_rates[0])
-        self.dropout_layers = []
-
-        for layer, layer_type, n_in, n_out, dr in zip(self.layers,
-                layers_types, self.layers_ins, self.layers_outs,
-                dropout_rates[1:] + [0]):  # !!! we do not dropout anything
-                                           # from the last layer !!!
-            if dr:
-                this_layer = layer_type(rng=numpy_rng,
-                        input=dropout_layer_input, n_in=n_in, n_out=n_out,
-                        W=layer.W * 1. / (1. - dr),
-                        b=layer.b * 1. / (1. - dr))
-                # N.B. dropout with dr==1 does not dropanything!!
-                this_layer.output = dropout(numpy_rng, this_layer.output, dr)
-            else:
-                this_layer = layer_type(rng=numpy_rng,
-                        input=dropout_layer_input, n_in=n_in, n_out=n_out,
-                        W=layer.W, b=layer.b)
 
-            assert hasattr(this_layer, 'output')
-            self.dropout_layers.append(this_layer)
-            dropout_layer_input = this_layer.output
-
-        assert hasattr(self.layers[-1], 'training_cost')
-        assert hasattr(self.layers[-1], 'errors')
-        # TODO standardize cost
-        # these are the dropout costs
-        self.mean_cost = self.dropout_layers[-1].negative_log_likelihood(self.y)
-        self.cost = self.dropout_layers[-1].training_cost(self.y)
-
-        # these is the non-dropout errors
-        self.errors = self.layers[-1].errors(self.y)
+    def _layer_input(self, x, i):
+        """ Inverted dropout of the input of the i-th layer, with rate
+        dropout_rates[i], from one random stream (the inference outputs are
+        built without it, see _without_dropout) """
+        dropped = dropout(self._theano_rng, x, self.dropout_rates[i])
+        if dropped is not x:
+            self._dropouts.append((dropped, x))
+        return dropped
 
     def __repr__(self):
         return super(DropoutNet, self).__repr__() + "\n"\
                 + "dropout rates: " + str(self.dropout_rates)
 
+    def get_config(self):
+        config = super(DropoutNet, self).get_config()
+        del config['momentum'], config['step_adapt_alpha']
+        config.update(dropout_rates=self.dropout_rates)
+        return config
+
+
+# optimizer states (lists of shared variables) saved with the parameters
+OPTIMIZER_STATES = ('_accugrads', '_accudeltas', '_avggrads', '_stepadapts')
+
+
+def _model_arrays(nnet, optimizer_state=False, copy=False):
+    """ (file name, value) of the parameters of nnet (and of its allocated
+    optimizer states if optimizer_state), copied if copy """
+    arrays = [('param_%02d.npy' % i, param.get_value(borrow=not copy))
+              for i, param in enumerate(nnet.params)]
+    if optimizer_state:
+        for name in OPTIMIZER_STATES:
+            for i, state in enumerate(getattr(nnet, name)):
+                arrays.append(('%s_%02d.npy' % (name.strip('_'), i),
+                               state.get_value(borrow=not copy)))
+    return arrays
+
+
+def _model_meta(nnet, optimizer_state=False, metadata=None):
+    return {'class': type(nnet).__name__,
+            'config': nnet.get_config(),
+            'n_params': len(nnet.params),
+            'optimizer_states': [name for name in OPTIMIZER_STATES
+                                 if optimizer_state and getattr(nnet, name)],
+            'metadata': metadata or {}}
+
+
+def _write_model(path, meta, arrays):
+    """ Writes model.json and the .npy arrays in a temporary directory then
+    renames it to path, so that a killed write leaves path unchanged """
+    import os, json, shutil
+    path = path.rstrip('/')
+    tmp = path + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for name, value in arrays:
+        numpy.save(os.path.join(tmp, name), value)
+    with open(os.path.join(tmp, 'model.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.isdir(path):
+        os.rename(path, path + '.old')
+        os.rename(tmp, path)
+        shutil.rmtree(path + '.old')
+    else:
+        os.rename(tmp, path)
+
+
+def save_model(nnet, path, optimizer_state=False, metadata=None):
+    """ Saves the architecture (get_config) and parameters of nnet in the
+    directory path, one .npy file per parameter. With optimizer_state, the
+    allocated optimizer states are saved too, so that training can resume
+    (see load_model and fit's resume_from). metadata (a JSON-able dict) is
+    saved in model.json. """
+    _write_model(path, _model_meta(nnet, optimizer_state, metadata),
+                 _model_arrays(nnet, optimizer_state))
+
+
+class CheckpointWriter(object):
+    """ Writes checkpoints of a net (parameters, optimizer states, metadata
+    and extra named arrays) to the directory path in a background thread.
+    write() only copies the arrays, at most one write is in flight. A
+    failed write is raised by the next wait() or write(). """
+    def __init__(self, path):
+        self.path = path
+        self._thread = None
+        self._error = None
+
+    def _write(self, meta, arrays):
+        try:
+            _write_model(self.path, meta, arrays)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def write(self, nnet, metadata=None, extra_arrays=()):
+        self.wait()
+        arrays = _model_arrays(nnet, optimizer_state=True, copy=True)
+        arrays += [(name, numpy.array(value)) for name, value in extra_arrays]
+        meta = _model_meta(nnet, True, metadata)
+        import threading
+        self._thread = threading.Thread(target=self._write,
+                                        args=(meta, arrays))
+        self._thread.start()
+
+    def wait(self):
+        """ Waits for the checkpoint being written, if any, and raises its
+        exception if it failed """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+
+def _read_meta(path):
+    import os, json
+    with open(os.path.join(path, 'model.json')) as f:
+        return json.load(f)
+
+
+def restore_checkpoint(nnet, path, mmap_mode='r'):
+    """ Sets the parameters and optimizer states of nnet to those saved in
+    the directory path (by save_model or CheckpointWriter), read memory
+    mapped with mmap_mode, and returns the saved metadata """
+    import os
+    meta = _read_meta(path)
+    for i, param in enumerate(nnet.params):
+        param.set_value(numpy.load(os.path.join(path, 'param_%02d.npy' % i),
+                                   mmap_mode=mmap_mode))
+    for name in meta.get('optimizer_states', []):
+        for i, state in enumerate(nnet._optimizer_state(str(name))):
+            state.set_value(numpy.load(os.path.join(path, '%s_%02d.npy'
+                                                    % (name.strip('_'), i)),
+                                       mmap_mode=mmap_mode))
+    return meta.get('metadata', {})
+
+
+def load_model(path, mmap_mode=None):
+    """ Rebuilds the net saved by save_model in the directory path (with its
+    optimizer states if they were saved) """
+    meta = _read_meta(path)
+    config = dict((str(k), v) for k, v in meta['config'].iteritems())
+    config['layers_types'] = [globals()[t] for t in config['layers_types']]
+    nnet = globals()[meta['class']](numpy_rng=numpy.random.RandomState(42),
+                                    **config)
+    restore_checkpoint(nnet, path, mmap_mode=mmap_mode)
+    return nnet
+
 
 def add_fit_score_predict_proba(class_to_chg):
     """ Mutates a class to add the fit() and score() functions to a NeuralNet.
@@ -417,43 +1288,160 @@ def add_fit_score_predict_proba(class_to_chg):
     from types import MethodType
     def fit(self, x_train, y_train, x_dev=None, y_dev=None,
             max_epochs=20, early_stopping=True, split_ratio=0.1, # TODO 100+ epochs
-            method='adadelta', verbose=False, plot=False):
+            patience=10, min_delta=0., eval_every=None,
+            method='adadelta', learning_rate=INIT_LR, verbose=False, plot=False,
+            shared_data=False, max_shared_bytes=MAX_SHARED_BYTES,
+            randomize=False, prefetch=0, class_weight=None,
+            sample_weight=None, n_jobs=1, hogwild=False, callbacks=(),
+            profile=False, checkpoint_dir=None, checkpoint_every=1,
+            resume_from=None, warm_start=False):
         """
         TODO
+
+        With shared_data=True, the training and dev sets are kept in theano
+        shared variables (see SharedDatasetIterator) and the compiled
+        functions slice the minibatches themselves, the sets are streamed in
+        chunks if they do not fit in max_shared_bytes.
+        With randomize=True, the training set is shuffled at each epoch.
+        With prefetch > 0 (and shared_data=False), the next prefetch training
+        minibatches are prepared in background threads (PrefetchingIterator).
+        With n_jobs > 1 (and shared_data=False, eval_every=None), the
+        minibatches are sharded across n_jobs worker processes (see
+        parallel.ParallelTrainer) whose gradients are averaged at each step,
+        or applied asynchronously with hogwild=True.
+        callbacks (see telemetry.Callback) get the logs of each minibatch
+        (cost, errors, fetch and train seconds), of each epoch (also eval
+        and snapshot seconds, samples/sec, dev error) and, at the end of
+        training, with profile=True, the theano profile of the trainer.
+        The epoch logs are kept in self._history.
+        With checkpoint_dir, the parameters, optimizer states, best
+        parameters and early stopping state are saved there every
+        checkpoint_every epochs (and at the end) by a background thread
+        (see CheckpointWriter). resume_from (such a checkpoint directory)
+        restores them and resumes training at the saved epoch (max_epochs
+        counting the epochs done before).
+        Training starts from the current parameters. With warm_start=True,
+        it also continues with the optimizer state of the previous fit or
+        partial_fit with the same method (the compiled trainers are reused
+        in any case).
+        class_weight ({class: weight} or 'balanced') and/or sample_weight
+        weight the training cost of each sample (see sample_weights).
+        learning_rate is used by the sgd, adagrad and rmsprop methods.
+        The dev set is evaluated after each epoch, or every eval_every
+        minibatches. With early_stopping=True, training stops after patience
+        evaluations without an improvement of the dev error of more than
+        min_delta, and the best parameters are restored at the end.
         """
-        import time, copy
-        if x_dev == None or y_dev == None:
-            from sklearn.cross_validation import train_test_split
-            x_train, x_dev, y_train, y_dev = train_test_split(x_train, y_train,
-                    test_size=split_ratio, random_state=42)
-        if method == 'sgd':
-            train_fn = self.get_SGD_trainer()
-        elif method == 'adagrad':
-            train_fn = self.get_adagrad_trainer()
-        elif method == 'adadelta':
-            train_fn = self.get_adadelta_trainer()
-        elif method == 'rmsprop':
-            train_fn = self.get_rmsprop_trainer(with_step_adapt=True,
-                    nesterov=False)
-        train_set_iterator = DatasetMiniBatchIterator(x_train, y_train)
-        dev_set_iterator = DatasetMiniBatchIterator(x_dev, y_dev)
-        train_scoref = self.score_classif(train_set_iterator)
-        dev_scoref = self.score_classif(dev_set_iterator)
-        best_dev_loss = numpy.inf
+        import time
+        w_train = None
+        if class_weight is not None or sample_weight is not None:
+            w_train = sample_weights(y_train, class_weight, sample_weight)
+        if x_dev is None or y_dev is None:
+            if isinstance(x_train, numpy.memmap):
+                # memory-mapped sets (see ingest) are stored shuffled, their
+                # last rows are used as dev set without copying
+                n_dev = max(1, int(split_ratio * x_train.shape[0]))
+                x_dev, y_dev = x_train[-n_dev:], y_train[-n_dev:]
+                x_train, y_train = x_train[:-n_dev], y_train[:-n_dev]
+                if w_train is not None:
+                    w_train = w_train[:-n_dev]
+            elif w_train is not None:
+                from sklearn.cross_validation import train_test_split
+                x_train, x_dev, y_train, y_dev, w_train, _ = train_test_split(
+                        x_train, y_train, w_train, test_size=split_ratio,
+                        random_state=42)
+            else:
+                from sklearn.cross_validation import train_test_split
+                x_train, x_dev, y_train, y_dev = train_test_split(x_train,
+                        y_train, test_size=split_ratio, random_state=42)
+        if shared_data:
+            train_set_iterator = SharedDatasetIterator(x_train, y_train,
+                    max_bytes=max_shared_bytes, randomize=randomize,
+                    w=w_train)
+            dev_set_iterator = SharedDatasetIterator(x_dev, y_dev,
+                    max_bytes=max_shared_bytes)
+        else:
+            train_set_iterator = DatasetMiniBatchIterator(x_train, y_train,
+                    randomize=randomize, w=w_train)
+            dev_set_iterator = DatasetMiniBatchIterator(x_dev, y_dev)
+        # compiled once, not cached for a SharedDatasetIterator
+        dev_fn = self._function('evaluate', dev_set_iterator)
+        train_batches = train_set_iterator
+        if prefetch > 0 and not shared_data and n_jobs <= 1:
+            train_batches = PrefetchingIterator(train_set_iterator, prefetch)
+        self._start_training(method, warm_start or resume_from is not None)
+        parallel_trainer = None
+        if n_jobs > 1:
+            if shared_data:
+                raise ValueError("n_jobs > 1 needs shared_data=False")
+            if eval_every:  # the workers train whole epochs
+                raise ValueError("n_jobs > 1 evaluates after each epoch, "
+                                 "eval_every should be None")
+            from parallel import ParallelTrainer
+            parallel_trainer = ParallelTrainer(self, train_set_iterator,
+                    n_jobs, method, hogwild=hogwild)
+        else:
+            train_fn = self.get_trainer(method, train_batches,
+                                        profile=profile)
         epoch = 0
-        # TODO early stopping (not just cross val, also stop training)
         if plot:
             verbose = True
             self._costs = []
             self._train_errors = []
-            self._dev_errors = []
             self._updates = []
+        self._dev_errors = []
+        self._history = []
+        # best parameters are copied in these preallocated buffers
+        best_params = self.snapshot_params()
+        state = {'best_dev_loss': numpy.inf, 'n_bad_evals': 0}
+        timings = {}  # seconds spent in evaluate() during an epoch
+        if resume_from is not None:
+            import os
+            metadata = restore_checkpoint(self, resume_from)
+            epoch = metadata['epoch']
+            self._dev_errors = metadata['dev_errors']
+            state.update(best_dev_loss=metadata['best_dev_loss'],
+                         n_bad_evals=metadata['n_bad_evals'])
+            for i, buf in enumerate(best_params):
+                numpy.copyto(buf, numpy.load(os.path.join(resume_from,
+                    'best_%02d.npy' % i), mmap_mode='r'))
+        checkpoint_writer = None
+        if checkpoint_dir is not None:
+            checkpoint_writer = CheckpointWriter(checkpoint_dir)
+
+        def checkpoint():
+            checkpoint_writer.write(self, {'epoch': epoch,
+                'dev_errors': [float(e) for e in self._dev_errors],
+                'best_dev_loss': float(state['best_dev_loss']),
+                'n_bad_evals': state['n_bad_evals'], 'method': method},
+                [('best_%02d.npy' % i, buf)
+                 for i, buf in enumerate(best_params)])
+
+        def evaluate():
+            """ evaluates on the dev set, snapshots the parameters if they
+            are the best so far and returns True if training should stop """
+            timer = time.time()
+            dev_errors = self.evaluate(dev_set_iterator, dev_fn)['error']
+            self._dev_errors.append(dev_errors)
+            timings['eval'] += time.time() - timer
+            if dev_errors < state['best_dev_loss'] - min_delta:
+                state['best_dev_loss'] = dev_errors
+                state['n_bad_evals'] = 0
+                timer = time.time()
+                self.snapshot_params(best_params)
+                timings['snapshot'] += time.time() - timer
+                if verbose:
+                    print('!!!  epoch %i, validation error of best model %f' %
+                          (epoch, dev_errors))
+            else:
+                state['n_bad_evals'] += 1
+            return early_stopping and state['n_bad_evals'] >= patience
 
-        init_lr = INIT_LR
-        if method == 'rmsprop':
-            init_lr = 1.E-6  # TODO REMOVE HACK
+        init_lr = numpy.float32(learning_rate)  # the trainers take an fscalar
         n_seen = 0
-        while epoch < max_epochs:
+        n_batches = 0
+        stop = False
+        while epoch < max_epochs and not stop:
             #lr = init_lr / (1 + init_lr * L2_LAMBDA * math.log(1+n_seen))
             #lr = init_lr / math.sqrt(1 + init_lr * L2_LAMBDA * n_seen/BATCH_SIZE) # try these
             lr = init_lr
@@ -461,24 +1449,61 @@ def add_fit_score_predict_proba(class_to_chg):
                 sys.stdout.write("\r%0.2f%%" % (epoch * 100./ max_epochs))
                 sys.stdout.flush()
             avg_costs = []
-            timer = time.time()
-            for x, y in train_set_iterator:
-                if method == 'sgd' or method == 'adagrad' or method == 'rmsprop':
-                    #avg_cost = train_fn(x, y, lr=1.E-2)
-                    avg_cost = train_fn(x, y, lr=lr)
-                elif method == 'adadelta':
-                    avg_cost = train_fn(x, y)
-                elif method == 'rmsprop':
-                    avg_cost = train_fn(x, y, lr=lr)
-                if type(avg_cost) == list:
-                    avg_costs.append(avg_cost[0])
-                else:
-                    avg_costs.append(avg_cost)
+            train_errors = 0
+            timings.update(fetch=0., train=0., eval=0., snapshot=0.)
+            n_samples = 0
+            epoch_timer = time.time()
+            if parallel_trainer is not None:
+                avg_costs, train_errors = parallel_trainer.train_epoch(lr)
+                timings['train'] = time.time() - epoch_timer
+                n_samples = x_train.shape[0]
+            else:
+                batches = iter(train_batches)
+                while True:
+                    timer = time.time()
+                    batch = next(batches, None)
+                    fetched = time.time()
+                    if batch is None:
+                        timings['fetch'] += fetched - timer
+                        break
+                    if method == 'adadelta':
+                        avg_cost = train_fn(*batch)
+                    else:
+                        avg_cost = train_fn(*batch, lr=lr)
+                    trained = time.time()
+                    timings['fetch'] += fetched - timer
+                    timings['train'] += trained - fetched
+                    if type(avg_cost) == list:
+                        train_errors += avg_cost[1]
+                        avg_costs.append(avg_cost[0])
+                    else:
+                        avg_costs.append(avg_cost)
+                    n_batches += 1
+                    if shared_data:  # (start, end) offsets
+                        batch_size = batch[1] - batch[0]
+                    else:
+                        batch_size = batch[0].shape[0]
+                    n_samples += batch_size
+                    if callbacks:
+                        batch_logs = {'epoch': epoch, 'batch': n_batches,
+                                      'n_samples': int(batch_size),
+                                      'cost': float(avg_costs[-1]),
+                                      'fetch_seconds': fetched - timer,
+                                      'train_seconds': trained - fetched}
+                        if type(avg_cost) == list:
+                            batch_logs['errors'] = int(avg_cost[1])
+                        for callback in callbacks:
+                            callback.on_batch_end(self, batch_logs)
+                    if eval_every and n_batches % eval_every == 0:
+                        stop = evaluate()
+                        if stop:
+                            break
             if verbose:
+                # running averages over the training steps of this epoch
                 mean_costs = numpy.mean(avg_costs)
-                mean_train_errors = numpy.mean(train_scoref())
+                mean_train_errors = float(train_errors) / x_train.shape[0]
                 print('  epoch %i took %f seconds' %
-                      (epoch, time.time() - timer))
+                      (epoch, time.time() - epoch_timer))
                 print('  epoch %i, avg costs %f' %
                       (epoch, mean_costs))
                 print('  epoch %i, training error %f' %
@@ -486,37 +1511,58 @@ def add_fit_score_predict_proba(class_to_chg):
                 if plot:
                     self._costs.append(mean_costs)
                     self._train_errors.append(mean_train_errors)
-            dev_errors = numpy.mean(dev_scoref())
-            if plot:
-                self._dev_errors.append(dev_errors)
-            if dev_errors < best_dev_loss:
-                best_dev_loss = dev_errors
-                best_params = copy.deepcopy(self.params)
-                if verbose:
-                    print('!!!  epoch %i, validation error of best model %f' %
-                          (epoch, dev_errors))
+            if not eval_every:
+                stop = evaluate()
+            seconds = time.time() - epoch_timer
+            logs = {'epoch': epoch, 'n_samples': n_samples,
+                    'cost': float(numpy.mean(avg_costs)),
+                    'train_error': float(train_errors) / max(n_samples, 1),
+                    'dev_error': float(self._dev_errors[-1])
+                                 if self._dev_errors else None,
+                    'seconds': seconds,
+                    'samples_per_second': n_samples / max(timings['fetch']
+                        + timings['train'], 1e-9)}
+            for name, value in timings.iteritems():
+                logs[name + '_seconds'] = value
+            self._history.append(logs)
+            for callback in callbacks:
+                callback.on_epoch_end(self, logs)
             epoch += 1
             n_seen += x_train.shape[0]
+            if checkpoint_writer is not None and epoch % checkpoint_every == 0:
+                checkpoint()
+        if train_batches is not train_set_iterator:
+            train_batches.close()
+        if parallel_trainer is not None:
+            parallel_trainer.close()
+        if checkpoint_writer is not None:
+            if epoch % checkpoint_every:
+                checkpoint()
+            checkpoint_writer.wait()
+        if callbacks:
+            logs = {'epochs': epoch, 'best_dev_error':
+                    float(state['best_dev_loss'])}
+            if profile and parallel_trainer is None:
+                from telemetry import profile_stats
+                logs['profile'] = profile_stats(train_fn.profile)
+            for callback in callbacks:
+                callback.on_train_end(self, logs)
         if not verbose:
             print("")
-        for i, param in enumerate(best_params):
-            self.params[i] = param
+        if verbose and stop:
+            print('  early stopping after %i epochs' % epoch)
+        if early_stopping and numpy.isfinite(state['best_dev_loss']):
+            self.restore_params(best_params)
 
     def score(self, x, y):
         """ error rates """
-        iterator = DatasetMiniBatchIterator(x, y)
-        scoref = self.score_classif(iterator)
-        return numpy.mean(scoref())
+        return self.evaluate(DatasetMiniBatchIterator(x, y))['error']
      
     def predict(self, x):
-        iterator = DatasetMiniBatchIterator(x)
-        predictf = self.predict_(iterator)
-        return numpy.concatenate(predictf(), axis=0)
+        return self.evaluate(DatasetMiniBatchIterator(x))['y_pred']
 
     def predict_proba(self, x):
-        iterator = DatasetMiniBatchIterator(x)
-        predictpbf = self.predict_proba_(iterator)
-        return numpy.concatenate(predictpbf(), axis=0)
+        return self.evaluate(DatasetMiniBatchIterator(x))['p_y_given_x']
 
     class_to_chg.fit = MethodType(fit, None, class_to_chg)
     class_to_chg.score = MethodType(score, None, class_to_chg)
@@ -526,70 +1572,133 @@ def add_fit_score_predict_proba(class_to_chg):
 
 DEEP = True
 ONEHOTENCODING = True
+SPARSE = False  # sparse CSR design matrix, for wide one hot encodings
+CLASS_WEIGHT = {0: 1., 1: 2.}  # weights the positives as if duplicated
+ENSEMBLE = False  # stacks the DNN, a random forest and GaussianNB
+ENSEMBLE_MEMBERS = ('dnn', 'rf', 'gnb')
 
-def model(X_train, y_train, X_test):
+def _fit_dnn(X_train, y_train):
     add_fit_score_predict_proba(DropoutNet)
     add_fit_score_predict_proba(RegularizedNet)
+    numpy_rng = numpy.random.RandomState(42)
+    #dnn = DropoutNet(numpy_rng=numpy_rng, n_ins=X_train.shape[1],
+    #    layers_types=[ReLU, ReLU, ReLU, LogisticRegression],
+    #    layers_sizes=[200, 200, 200],
+    #    dropout_rates=[0.2, 0.5, 0.5, 0.5],
+        #layers_types=[LogisticRegression],
+        #layers_sizes=[],
+        #dropout_rates=[0.0],
+    #    n_outs=2,
+    #    debugprint=0)
+    dnn = RegularizedNet(numpy_rng=numpy_rng, n_ins=X_train.shape[1],
+        layers_types=[LogisticRegression],
+        layers_sizes=[],
+        n_outs=2,
+        debugprint=0,
+        sparse_input=sp.issparse(X_train))
+    #clf = Pipeline([('imputer', Imputer()),
+    #    ('dnn', dnn)])
+    #clf.fit(X_train, y_train)
+    dnn.fit(X_train, y_train, max_epochs=50, class_weight=CLASS_WEIGHT)
+    return dnn
+
+
+def _fit_gnb(X_train, y_train):
+    from sklearn.naive_bayes import GaussianNB
+    gnb = GaussianNB()
+    gnb.fit(X_train, y_train,
+            sample_weight=sample_weights(y_train, CLASS_WEIGHT))
+    return gnb
+
+
+def _fit_rf(X_train, y_train):
+    from sklearn.ensemble import RandomForestClassifier
+    rf = RandomForestClassifier(n_estimators=200, random_state=42)
+    rf.fit(X_train, y_train,
+           sample_weight=sample_weights(y_train, CLASS_WEIGHT))
+    return rf
+
+
+# (X_fit, y_fit, X_blend, X_test) of ensemble(), inherited by the forked
+# workers: the design matrices (memory-mapped or not) are not pickled
+_ensemble_data = None
+
+
+def _fit_member(name):
+    """ Trains the ensemble member name on the shared data and returns its
+    probabilities of the positive class on the blend and test sets """
+    import time
+    X_fit, y_fit, X_blend, X_test = _ensemble_data
+    timer = time.time()
+    if name == 'gnb' and sp.issparse(X_fit):
+        X_fit, X_blend, X_test = X_fit.toarray(), X_blend.toarray(), \
+                X_test.toarray()
+    clf = {'dnn': _fit_dnn, 'rf': _fit_rf, 'gnb': _fit_gnb}[name](X_fit,
+                                                                  y_fit)
+    return (name, clf.predict_proba(X_blend)[:, 1],
+            clf.predict_proba(X_test)[:, 1], time.time() - timer)
+
+
+def ensemble(X_train, y_train, X_test, members=ENSEMBLE_MEMBERS,
+             blend_ratio=0.2):
+    """ Trains the members (see _fit_member) concurrently, one process each,
+    on the first rows of X_train and stacks their probabilities with a
+    logistic regression learned on the last blend_ratio rows """
+    global _ensemble_data
+    from multiprocessing import Pool
+    from sklearn.linear_model import LogisticRegression as Combiner
+    from sklearn.metrics import roc_auc_score
+    n_blend = max(1, int(blend_ratio * X_train.shape[0]))
+    y_blend = y_train[-n_blend:]
+    _ensemble_data = (X_train[:-n_blend], y_train[:-n_blend],
+                      X_train[-n_blend:], X_test)
+    pool = Pool(len(members))
+    try:
+        results = pool.map(_fit_member, members)
+    finally:
+        pool.close()
+        pool.join()
+        _ensemble_data = None
+    for name, p_blend, _, seconds in results:
+        print name, "blend AUC:", roc_auc_score(y_blend, p_blend),
+        print "(%f seconds)" % seconds
+    combiner = Combiner().fit(numpy.column_stack([r[1] for r in results]),
+                              y_blend)
+    print "combiner weights:", combiner.coef_
+    p_test = numpy.column_stack([r[2] for r in results])
+    return combiner.predict(p_test), combiner.predict_proba(p_test)
+
+
+def model(X_train, y_train, X_test):
+    if ENSEMBLE:
+        return ensemble(X_train, y_train, X_test)
     DEEP = True
     if DEEP:
-        numpy_rng = numpy.random.RandomState(42)
-        #dnn = DropoutNet(numpy_rng=numpy_rng, n_ins=X_train.shape[1],
-        #    layers_types=[ReLU, ReLU, ReLU, LogisticRegression],
-        #    layers_sizes=[200, 200, 200],
-        #    dropout_rates=[0.2, 0.5, 0.5, 0.5],
-            #layers_types=[LogisticRegression],
-            #layers_sizes=[],
-            #dropout_rates=[0.0],
-        #    n_outs=2,
-        #    debugprint=0)
-        dnn = RegularizedNet(numpy_rng=numpy_rng, n_ins=X_train.shape[1],
-            layers_types=[LogisticRegression],
-            layers_sizes=[],
-            n_outs=2,
-            debugprint=0)
-        #clf = Pipeline([('imputer', Imputer()),
-        #    ('dnn', dnn)])
-        #clf.fit(X_train, y_train)
-        dnn.fit(X_train, y_train, max_epochs=50)
+        dnn = _fit_dnn(X_train, y_train)
         y_pred = dnn.predict(X_test)
         y_score = dnn.predict_proba(X_test)
     else:
-        from sklearn.naive_bayes import GaussianNB
-        gnb = GaussianNB()
-        gnb.fit(X_train, y_train)
+        gnb = _fit_gnb(X_train, y_train)
         y_pred = gnb.predict(X_test)
         y_score = gnb.predict_proba(X_test)
     return y_pred, y_score
 
 if __name__ == '__main__':
-    import pandas as pd
-    import numpy as np
-    df = pd.read_csv('train.csv')
-    y_train = np.array(df['TARGET'].values, dtype='int32')
-    X_train = np.array(df.drop('TARGET', axis=1).values, dtype='float32')
-    #X_train = df.drop('TARGET', axis=1).values
-    #X_train = np.nan_to_num(X_train)
-    X_train = Imputer().fit_transform(X_train)
-
-    # WEIGHTING
-    X_train = np.concatenate([X_train, X_train[y_train==1]], axis=0)
-    y_train = np.concatenate([y_train, y_train[y_train==1]], axis=0)
-    from sklearn import utils
-    print X_train.shape
-    print y_train.shape
-    X_train, y_train = utils.shuffle(X_train, y_train)
-
-    # ONE HOT ENCODING
-    if ONEHOTENCODING:
-        from sklearn.preprocessing import OneHotEncoder
-        categ_inds = filter(lambda (_, k): k.isupper(), enumerate(df.keys()))
-        ohe = OneHotEncoder(categorical_features=zip(*categ_inds)[0], sparse=False)
-        X_train = np.asarray(ohe.fit_transform(X_train), dtype='float32')
-        print X_train.shape
-
-    from sklearn.cross_validation import train_test_split
-    X_train, X_test, y_train, y_test = train_test_split(X_train, y_train,
-            test_size=0.2)
+    from ingest import CSVIngester
+    # imputation and one hot encoding are streamed from the CSV to a
+    # memory-mapped design matrix, the positives are weighted (CLASS_WEIGHT)
+    # in the training cost rather than duplicated. The fitted statistics and
+    # the design matrix are cached (in ingest.CACHE_DIR) for the next runs.
+    ingester = CSVIngester(target='TARGET', one_hot=ONEHOTENCODING,
+                           oversample=False, shuffle=True)
+    X, y = ingester.fit_transform_cached('train.csv', sparse=SPARSE)
+    print X.shape
+    print y.shape
+
+    # the rows are written in a random order: split without copying
+    n_test = int(0.2 * X.shape[0])
+    X_train, X_test = X[n_test:], X[:n_test]
+    y_train, y_test = y[n_test:], y[:n_test]
     y_pred, y_score = model(X_train, y_train, X_test)
     print y_pred.shape
     print y_score.shape
@@ -0,0 +1,125 @@
+""" Theano-free inference: export of a trained NeuralNet to a compact weights
+file and a pure NumPy forward pass reproducing its predict/predict_proba.
+
+    from numpy_inference import export_weights, NumpyNet
+    export_weights(dnn, 'dnn.npz', storage='int8')  # where theano is
+    net = NumpyNet('dnn.npz')                       # on the serving hosts
+    y_score = net.predict_proba(X_test)
+"""
+import numpy
+
+BATCH_SIZE = 100  # default number of rows propagated at once
+STORAGES = ('float32', 'float16', 'int8')
+ACTIVATIONS = {'Linear': 'linear', 'ReLU': 'relu', 'SigmoidLayer': 'sigmoid',
+               'LogisticRegression': 'softmax'}
+
+
+def export_weights(nnet, path, storage='float32'):
+    """ Writes the layers of nnet (Linear, ReLU, SigmoidLayer and
+    LogisticRegression) to the .npz file path. The weight matrices are
+    stored as float32, float16 or int8 (with one float32 scale per output
+    unit), the biases as float32. """
+    if storage not in STORAGES:
+        raise ValueError("storage should be one of %s" % (STORAGES,))
+    # LogisticRegression is an old-style class: type() would be 'instance'
+    activations = [ACTIVATIONS[layer.__class__.__name__]
+                   for layer in nnet.layers]
+    arrays = {'activations': numpy.array(activations),
+              'storage': numpy.array(storage)}
+    for i, layer in enumerate(nnet.layers):
+        W = layer.W.get_value(borrow=True)
+        if storage == 'int8':
+            scale = numpy.abs(W).max(axis=0) / 127.
+            scale[scale == 0] = 1.
+            arrays['W_%i' % i] = numpy.asarray(numpy.round(W / scale),
+                                               dtype='int8')
+            arrays['scale_%i' % i] = numpy.asarray(scale, dtype='float32')
+        else:
+            arrays['W_%i' % i] = numpy.asarray(W, dtype=storage)
+        arrays['b_%i' % i] = numpy.asarray(layer.b.get_value(borrow=True),
+                                           dtype='float32')
+    numpy.savez(path, **arrays)
+
+
+class NumpyNet(object):
+    """ Forward pass of a net exported by export_weights, in float32.
+
+    float16 and int8 weights are kept as such in memory and dequantized one
+    layer at a time, in a float32 buffer of the size of the largest weight
+    matrix, before its (BLAS) dot product: a worker holds the quantized
+    weights plus one layer in float32, at the cost of a conversion of each
+    weight matrix per batch (of up to batch_size rows).
+    The activations are computed in place in a workspace preallocated for
+    batch_size rows, so scoring allocates nothing but the returned arrays.
+    """
+    def __init__(self, path, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        with numpy.load(path) as f:
+            self.activations = [str(a) for a in f['activations']]
+            self.storage = str(f['storage'])
+            self.W = []
+            self.scales = []
+            self.b = []
+            for i in xrange(len(self.activations)):
+                self.W.append(numpy.ascontiguousarray(f['W_%i' % i]))
+                self.scales.append(f['scale_%i' % i]
+                                   if self.storage == 'int8' else None)
+                self.b.append(f['b_%i' % i])
+        self.n_ins = self.W[0].shape[0]
+        self.n_outs = self.W[-1].shape[1]
+        self._dequantized = None
+        if self.storage != 'float32':
+            self._dequantized = numpy.empty((max(W.size for W in self.W),),
+                                            dtype='float32')
+        self._workspace = [numpy.empty((batch_size, W.shape[1]),
+                                       dtype='float32') for W in self.W]
+
+    def _weights(self, i):
+        """ The i-th weight matrix in float32, without its int8 scale """
+        W = self.W[i]
+        if self._dequantized is None:
+            return W
+        W32 = self._dequantized[:W.size].reshape(W.shape)
+        W32[...] = W
+        return W32
+
+    def _forward(self, x):
+        """ Returns the output of the last layer (in the workspace) for x, of
+        at most batch_size rows """
+        h = x
+        for i, (b, activation) in enumerate(zip(self.b, self.activations)):
+            W = self._weights(i)
+            out = self._workspace[i][:x.shape[0]]
+            if hasattr(h, 'tocsr'):  # scipy.sparse input
+                out[...] = h.dot(W)
+            else:
+                numpy.dot(h, W, out=out)
+            if self.scales[i] is not None:
+                out *= self.scales[i]
+            out += b
+            if activation == 'relu':
+                numpy.maximum(out, 0., out=out)
+            elif activation == 'sigmoid':
+                numpy.negative(out, out=out)
+                numpy.exp(out, out=out)
+                out += 1.
+                numpy.reciprocal(out, out=out)
+            elif activation == 'softmax':
+                out -= out.max(axis=1)[:, numpy.newaxis]
+                numpy.exp(out, out=out)
+                out /= out.sum(axis=1)[:, numpy.newaxis]
+            h = out
+        return h
+
+    def predict_proba(self, x):
+        """ p(y|x) for all the rows of x, batch_size rows at a time """
+        if not hasattr(x, 'tocsr'):
+            x = numpy.ascontiguousarray(x, dtype='float32')
+        p_y_given_x = numpy.empty((x.shape[0], self.n_outs), dtype='float32')
+        for i in xrange(0, x.shape[0], self.batch_size):
+            p_y_given_x[i:i+self.batch_size] = self._forward(
+                    x[i:i+self.batch_size])
+        return p_y_given_x
+
+    def predict(self, x):
+        return numpy.argmax(self.predict_proba(x), axis=1)
@@ -0,0 +1,228 @@
+""" Data-parallel training of a NeuralNet in worker processes.
+
+The minibatches of an epoch are sharded across n_workers forked processes,
+each running the compiled gradient function (NeuralNet.get_gradient_fn) on
+its minibatches. The parameters are shared with the workers through shared
+memory buffers, in one of two modes:
+
+- synchronous (default): each step, every worker computes the gradient of
+  one minibatch, the parent averages them (weighted by the minibatch sizes)
+  and applies the update rule of the training method on the averaged
+  gradient (NeuralNet.get_apply_gradients_fn), so a step sees n_workers
+  minibatches;
+- hogwild=True (Niu et al. 2011): the workers apply the update rule with
+  their own optimizer state and add their parameter steps to the shared
+  parameters without any locking.
+
+The data is not copied: the forked workers read the rows of x (an array, a
+memory-mapped array or a CSR matrix) inherited from the parent. Each worker
+reseeds the random streams of the net (e.g. for the dropout masks).
+An exception in a worker, or its death, is raised in the parent.
+"""
+import ctypes
+import multiprocessing
+import Queue
+import numpy
+
+
+class SharedArrays(object):
+    """ Arrays of the shapes and dtypes of the values of params, in one
+    block of shared memory """
+    def __init__(self, params):
+        values = [param.get_value(borrow=True) for param in params]
+        offsets = [0]
+        for value in values:
+            offsets.append(offsets[-1] + (value.nbytes + 63) // 64 * 64)
+        self._raw = multiprocessing.RawArray(ctypes.c_char, offsets[-1] or 1)
+        self.arrays = [numpy.frombuffer(self._raw, dtype=value.dtype,
+                                        count=value.size, offset=offset)
+                       .reshape(value.shape)
+                       for value, offset in zip(values, offsets)]
+
+
+def _rows(iterator, rows):
+    """ Number of rows of iterator.x in a slice of rows (the last one may
+    be short) or an array of indices """
+    if isinstance(rows, slice):
+        return len(xrange(*rows.indices(iterator.x.shape[0])))
+    return len(rows)
+
+
+def _batch(iterator, rows):
+    """ The minibatch at rows of the DatasetMiniBatchIterator iterator """
+    if iterator.w is not None:
+        return (iterator.x[rows], iterator.y[rows], iterator.w[rows])
+    return (iterator.x[rows], iterator.y[rows])
+
+
+def _worker(nnet, iterator, grad_fn, apply_fn, params, grads, tasks,
+            results, seed):
+    """ Loop of a worker process: computes the gradients of the minibatches
+    received in tasks until it gets None. Puts ('done', (cost, errors,
+    n_rows)) in results for each task, or ('error', traceback) and exits.
+    """
+    try:
+        _work(nnet, iterator, grad_fn, apply_fn, params, grads, tasks,
+              results, seed)
+    except Exception:
+        import traceback
+        results.put(('error', traceback.format_exc()))
+
+
+def _work(nnet, iterator, grad_fn, apply_fn, params, grads, tasks, results,
+          seed):
+    if nnet._theano_rng is not None:  # forked with the parent's state
+        nnet._theano_rng.seed(seed)
+    # local copy of the shared parameters at the start of a hogwild step
+    before = [numpy.empty_like(p) for p in params.arrays]
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        mode, batches, lr = task
+        cost = 0.
+        errors = 0
+        n = 0
+        for rows in batches:
+            if mode == 'hogwild':
+                for param, buf, shared in zip(nnet.params, before,
+                                              params.arrays):
+                    numpy.copyto(buf, shared)
+                    param.set_value(buf, borrow=False)
+            else:  # the parameters are views on the shared memory
+                for param, shared in zip(nnet.params, params.arrays):
+                    param.set_value(shared, borrow=True)
+            outputs = grad_fn(*_batch(iterator, rows))
+            n_rows = _rows(iterator, rows)
+            if mode == 'hogwild':
+                apply_fn(*(outputs[2:] + lr))
+                for param, buf, shared in zip(nnet.params, before,
+                                              params.arrays):
+                    # lock free: other workers may be writing too
+                    numpy.subtract(param.get_value(borrow=True), buf, out=buf)
+                    shared += buf
+            else:  # sum of the gradients of the samples, averaged by parent
+                for gparam, buf in zip(outputs[2:], grads.arrays):
+                    numpy.multiply(gparam, n_rows, out=buf)
+            cost += float(outputs[0]) * n_rows
+            errors += int(outputs[1])
+            n += n_rows
+        results.put(('done', (cost, errors, n)))
+
+
+class ParallelTrainer(object):
+    """ Trains nnet with method on the minibatches of iterator (a
+    DatasetMiniBatchIterator) in n_workers forked processes, see above.
+
+    train_epoch() returns the mean costs of the steps of one epoch and the
+    number of training errors, and leaves the parameters of nnet updated.
+    close() stops the workers, terminate() kills them.
+    """
+    def __init__(self, nnet, iterator, n_workers=None, method='adadelta',
+                 hogwild=False):
+        self.nnet = nnet
+        self.iterator = iterator
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.method = method
+        self.hogwild = hogwild
+        # compiled once before forking, inherited by the workers
+        grad_fn = nnet.get_gradient_fn(iterator)
+        self._apply_fn = nnet.get_apply_gradients_fn(method)
+        self.params = SharedArrays(nnet.params)
+        self._grads = [SharedArrays(nnet.params)
+                       for _ in xrange(self.n_workers)]
+        self._sum_grads = [numpy.empty_like(a) for a in self.params.arrays]
+        self._results = multiprocessing.Queue()
+        self._tasks = []
+        self._workers = []
+        seeds = nnet._numpy_rng.randint(2 ** 30, size=self.n_workers)
+        for i in xrange(self.n_workers):
+            tasks = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_worker,
+                    args=(nnet, iterator, grad_fn, self._apply_fn,
+                          self.params, self._grads[i], tasks, self._results,
+                          seeds[i]))
+            worker.daemon = True
+            worker.start()
+            self._tasks.append(tasks)
+            self._workers.append(worker)
+
+    def _lr(self, lr):
+        if self.method == 'adadelta':
+            return []
+        return [numpy.float32(lr)]
+
+    def _result(self, poll_seconds=1.):
+        """ The next (cost, errors, n_rows) result of a worker. Raises
+        RuntimeError (after terminating the workers) if a worker failed or
+        died. """
+        while True:
+            try:
+                status, result = self._results.get(timeout=poll_seconds)
+            except Queue.Empty:
+                dead = [w for w in self._workers if not w.is_alive()]
+                if not dead:
+                    continue
+                self.terminate()
+                raise RuntimeError("worker process died (exit code %s)"
+                                   % dead[0].exitcode)
+            if status == 'error':
+                self.terminate()
+                raise RuntimeError("worker process failed:\n" + result)
+            return result
+
+    def _publish(self):
+        """ Copies the parameters of nnet to the shared parameters """
+        for param, shared in zip(self.nnet.params, self.params.arrays):
+            numpy.copyto(shared, param.get_value(borrow=True))
+
+    def train_epoch(self, lr=None):
+        self._publish()
+        batches = list(self.iterator.batch_indices())
+        costs = []
+        errors = 0
+        if self.hogwild:
+            for i, tasks in enumerate(self._tasks):
+                tasks.put(('hogwild', batches[i::self.n_workers],
+                           self._lr(lr)))
+            for _ in self._tasks:
+                cost, n_errors, n = self._result()
+                if n:
+                    costs.append(cost / n)
+                errors += n_errors
+            for param, shared in zip(self.nnet.params, self.params.arrays):
+                param.set_value(shared, borrow=False)
+            return costs, errors
+        for step in xrange(0, len(batches), self.n_workers):
+            step_batches = batches[step:step+self.n_workers]
+            for rows, tasks in zip(step_batches, self._tasks):
+                tasks.put(('sync', [rows], None))
+            step_cost = 0.
+            n_rows = 0
+            for _ in step_batches:
+                cost, n_errors, n = self._result()
+                step_cost += cost
+                errors += n_errors
+                n_rows += n
+            for i, sum_grad in enumerate(self._sum_grads):
+                numpy.copyto(sum_grad, self._grads[0].arrays[i])
+                for grads in self._grads[1:len(step_batches)]:
+                    sum_grad += grads.arrays[i]
+                sum_grad /= n_rows
+            self._apply_fn(*(self._sum_grads + self._lr(lr)))
+            self._publish()
+            costs.append(step_cost / n_rows)
+        return costs, errors
+
+    def close(self):
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def terminate(self):
+        """ Stops the workers without waiting for their tasks """
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join()
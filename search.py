@@ -0,0 +1,260 @@
+""" Parallel hyperparameter search over the nets of model.py.
+
+Grid search, random search and successive halving over the net class
+(DropoutNet, RegularizedNet), layers_sizes, dropout_rates, L1_reg/L2_reg,
+the training method and its learning_rate. The trials run in a process pool,
+each worker with its own theano compile dir (base_compiledir) so that the
+workers do not contend for the compile lock.
+
+    python search.py train.X.npy train.y.npy --strategy halving --n-jobs 8
+
+With successive halving, all the configurations are trained for min_epochs
+epochs, the best 1/eta of them (on their best per-epoch dev error, see
+fit()) are trained eta times longer, and so on up to max_epochs: weak trials
+are cut early.
+"""
+import itertools
+import json
+import os
+import sys
+import time
+import numpy
+
+# the hand tuned configurations of model(), as a search space
+SPACE = {'class': ['DropoutNet', 'RegularizedNet'],
+         'layers_sizes': [[], [200], [200, 200], [200, 200, 200]],
+         'dropout_rates': [[0.0], [0.2, 0.5], [0.0, 0.5]],
+         'L1_reg': [0.0, 0.001, 0.1],
+         'L2_reg': [0.0, 0.001, 0.1],
+         'method': ['adadelta', 'rmsprop'],
+         'learning_rate': [0.001, 0.01]}
+# hyperparameters used only by some classes or methods
+RELEVANT = {'dropout_rates': lambda c: c['class'] == 'DropoutNet',
+            'L1_reg': lambda c: c['class'] == 'RegularizedNet',
+            'L2_reg': lambda c: c['class'] == 'RegularizedNet',
+            'learning_rate': lambda c: c['method'] != 'adadelta'}
+SPLIT_RATIO = 0.1  # last rows of the training set used as dev set
+
+
+def _canonical(config):
+    """ config without the hyperparameters irrelevant to it """
+    return dict((k, v) for k, v in config.iteritems()
+                if k not in RELEVANT or RELEVANT[k](config))
+
+
+def _unique(configs):
+    seen = set()
+    for config in configs:
+        config = _canonical(config)
+        key = json.dumps(config, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            yield config
+
+
+def grid_configs(space=SPACE):
+    """ All the (distinct) configurations of space """
+    keys = sorted(space)
+    return list(_unique(dict(zip(keys, values))
+                for values in itertools.product(*[space[k] for k in keys])))
+
+
+def random_configs(space=SPACE, n_trials=16, random_state=42):
+    """ n_trials distinct configurations drawn uniformly from space (fewer
+    if the space is smaller) """
+    rng = numpy.random.RandomState(random_state)
+    keys = sorted(space)
+    configs = []
+    for _ in xrange(100 * n_trials):
+        if len(configs) >= n_trials:
+            break
+        config = dict((k, space[k][rng.randint(len(space[k]))])
+                      for k in keys)
+        configs = list(_unique(configs + [config]))
+    return configs
+
+
+def build_net(config, n_ins, n_outs=2, random_state=42):
+    """ The net of config, ReLU hidden layers and a LogisticRegression.
+    dropout_rates are padded with their last rate (or truncated) to the
+    number of layers. """
+    import model
+    layers_sizes = list(config['layers_sizes'])
+    layers_types = [model.ReLU] * len(layers_sizes) + \
+            [model.LogisticRegression]
+    kwargs = {}
+    if config['class'] == 'DropoutNet':
+        rates = list(config['dropout_rates'])
+        n = len(layers_sizes) + 1
+        kwargs['dropout_rates'] = (rates + rates[-1:] * n)[:n]
+    elif config['class'] == 'RegularizedNet':
+        kwargs['L1_reg'] = config['L1_reg']
+        kwargs['L2_reg'] = config['L2_reg']
+    net_class = getattr(model, config['class'])
+    model.add_fit_score_predict_proba(net_class)
+    return net_class(numpy_rng=numpy.random.RandomState(random_state),
+                     n_ins=n_ins, layers_types=layers_types,
+                     layers_sizes=layers_sizes, n_outs=n_outs, **kwargs)
+
+
+def _init_worker(compile_root):
+    """ Gives this worker process its own theano compile dir, before theano
+    is imported (model imports it lazily) """
+    compiledir = os.path.join(compile_root, 'worker_%i' % os.getpid())
+    flags = os.environ.get('THEANO_FLAGS', '')
+    os.environ['THEANO_FLAGS'] = ','.join(
+            [f for f in flags.split(',') if f] + ['base_compiledir=' +
+                                                  compiledir])
+
+
+def _run_trial(job):
+    """ Trains the net of job['config'] for job['n_epochs'] more epochs
+    (resuming from job['model_dir'], with its optimizer state, if it
+    exists) and saves it there """
+    import model
+    t0 = time.time()
+    result = {'trial': job['trial'], 'config': job['config']}
+    try:
+        x = numpy.load(job['x_path'], mmap_mode='r')
+        y = numpy.load(job['y_path'])
+        n_dev = max(1, int(job['split_ratio'] * x.shape[0]))
+        if os.path.isdir(job['model_dir']):
+            nnet = model.load_model(job['model_dir'])
+            model.add_fit_score_predict_proba(type(nnet))
+        else:
+            nnet = build_net(job['config'], x.shape[1],
+                             int(y.max()) + 1)
+        nnet.fit(x[:-n_dev], y[:-n_dev], x[-n_dev:], y[-n_dev:],
+                 max_epochs=job['n_epochs'], patience=job['patience'],
+                 method=job['config']['method'],
+                 learning_rate=numpy.float32(job['config'].get(
+                     'learning_rate', model.INIT_LR)),
+                 class_weight=job['class_weight'], warm_start=True)
+        model.save_model(nnet, job['model_dir'], optimizer_state=True)
+        result['dev_errors'] = [float(e) for e in nnet._dev_errors]
+    except Exception:  # see search() for the failures that are fatal
+        import traceback
+        result['error'] = traceback.format_exc()
+        result['dev_errors'] = []
+    result['seconds'] = time.time() - t0
+    return result
+
+
+def _best_error(trial):
+    return min(trial['dev_errors']) if trial['dev_errors'] else numpy.inf
+
+
+def _check_methods(trials):
+    """ Raises if all the trials of a training method failed, which is a
+    bug rather than diverging configurations """
+    methods = set(t['config']['method'] for t in trials)
+    for method in sorted(methods):
+        method_trials = [t for t in trials
+                         if t['config']['method'] == method]
+        if all('error' in t for t in method_trials):
+            raise RuntimeError("all the %i trials of method %s failed, the "
+                               "first one with:\n%s"
+                               % (len(method_trials), method,
+                                  method_trials[0]['error']))
+
+
+def search(x, y, space=SPACE, strategy='random', n_trials=16, max_epochs=20,
+           min_epochs=2, eta=3, patience=10, n_jobs=None, work_dir=None,
+           class_weight=None, random_state=42, verbose=True):
+    """ Searches the hyperparameters of space with strategy 'grid', 'random'
+    or 'halving' (successive halving of n_trials random configurations,
+    from min_epochs epochs). x and y are arrays or .npy files (x is read
+    memory-mapped by the workers), their last rows are the dev set.
+
+    Returns the trials sorted by best dev error: dicts of config,
+    dev_errors (per epoch), dev_error, epochs, seconds and model_dir (where
+    the trained net is saved, see model.load_model). A failed trial (its
+    traceback, in 'error', is written to stderr) is dropped, but the search
+    fails if all the trials of a training method do.
+    """
+    import tempfile
+    from multiprocessing import Pool
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='search_')
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    x_path, y_path = x, y
+    if not isinstance(x, basestring):
+        x_path = os.path.join(work_dir, 'x.npy')
+        numpy.save(x_path, numpy.asarray(x, dtype='float32'))
+    if not isinstance(y, basestring):
+        y_path = os.path.join(work_dir, 'y.npy')
+        numpy.save(y_path, numpy.asarray(y, dtype='int32'))
+
+    if strategy == 'grid':
+        configs = grid_configs(space)
+    elif strategy in ('random', 'halving'):
+        configs = random_configs(space, n_trials, random_state)
+    else:
+        raise ValueError("strategy should be 'grid', 'random' or 'halving'")
+    trials = [{'trial': i, 'config': config, 'dev_errors': [], 'epochs': 0,
+               'seconds': 0., 'model_dir': os.path.join(work_dir,
+                                                        'trial_%03d' % i)}
+              for i, config in enumerate(configs)]
+    if strategy == 'halving':
+        budgets = [min(min_epochs * eta ** i, max_epochs) for i in
+                   xrange(int(numpy.ceil(numpy.log(max_epochs / float(
+                       min_epochs)) / numpy.log(eta))) + 1)]
+    else:
+        budgets = [max_epochs]
+
+    pool = Pool(n_jobs, initializer=_init_worker,
+                initargs=(os.path.join(work_dir, 'compiledir'),))
+    try:
+        alive = trials
+        for rung, budget in enumerate(budgets):
+            jobs = [{'trial': t['trial'], 'config': t['config'],
+                     'x_path': x_path, 'y_path': y_path,
+                     'split_ratio': SPLIT_RATIO, 'model_dir': t['model_dir'],
+                     'n_epochs': budget - t['epochs'], 'patience': patience,
+                     'class_weight': class_weight} for t in alive]
+            for result in pool.imap_unordered(_run_trial, jobs):
+                trial = trials[result['trial']]
+                trial['dev_errors'] += result['dev_errors']
+                trial['epochs'] = budget
+                trial['seconds'] += result['seconds']
+                if 'error' in result:
+                    trial['error'] = result['error']
+                    sys.stderr.write('trial %i failed:\n%s' % (
+                        trial['trial'], result['error']))
+                if verbose:
+                    print 'rung %i, trial %i: dev error %f (%i epochs) %s' % (
+                        rung, trial['trial'], _best_error(trial), budget,
+                        json.dumps(trial['config'], sort_keys=True))
+            _check_methods(trials)
+            alive = sorted((t for t in alive if 'error' not in t),
+                           key=_best_error)
+            alive = alive[:max(1, len(alive) // eta)]
+    finally:
+        pool.close()
+        pool.join()
+    for trial in trials:
+        trial['dev_error'] = _best_error(trial)
+    return sorted(trials, key=_best_error)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('x', help=".npy design matrix (see ingest)")
+    parser.add_argument('y', help=".npy targets")
+    parser.add_argument('--strategy', choices=['grid', 'random', 'halving'],
+                        default='halving')
+    parser.add_argument('--n-trials', type=int, default=27)
+    parser.add_argument('--max-epochs', type=int, default=18)
+    parser.add_argument('--min-epochs', type=int, default=2)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--n-jobs', type=int, default=None,
+                        help="worker processes (default: all the cores)")
+    parser.add_argument('--work-dir', default=None)
+    args = parser.parse_args()
+    trials = search(args.x, args.y, strategy=args.strategy,
+                    n_trials=args.n_trials, max_epochs=args.max_epochs,
+                    min_epochs=args.min_epochs, eta=args.eta,
+                    n_jobs=args.n_jobs, work_dir=args.work_dir)
+    sys.stdout.write(json.dumps(trials[:5], indent=2, sort_keys=True) + '\n')
@@ -0,0 +1,223 @@
+""" Low-latency scoring of a trained NeuralNet with dynamic micro-batching.
+
+Concurrent requests (rows of features) are queued and merged by a
+MicroBatcher into minibatches of at most max_batch_size rows, waiting at most
+max_wait seconds for a minibatch to fill, so that one compiled p_y_given_x
+call (one T.dot per layer) serves many requests.
+
+The server speaks JSON lines over a Unix socket or a loopback TCP port:
+each request is {"x": [...]} (one row) or {"x": [[...], ...]} (several rows)
+and is answered by {"p_y_given_x": [...]} (or {"error": "..."}).
+
+    python serve.py model_dir --socket /tmp/dnn.sock
+    python serve.py model_dir --port 8765
+    python serve.py weights.npz --backend numpy --socket /tmp/dnn.sock
+
+With --backend numpy, the weights exported by numpy_inference.export_weights
+are served without importing theano.
+"""
+import threading
+import Queue
+import SocketServer
+import json
+import sys
+import time
+import numpy
+
+MAX_BATCH_SIZE = 64  # default maximum number of rows per compiled call
+MAX_WAIT = 0.002     # default maximum seconds to wait for a batch to fill
+
+
+class _Request(object):
+    """ Rows to score and the event signaling that their result is ready """
+    def __init__(self, x):
+        self.x = x
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """ Merges the rows submitted by concurrent threads into minibatches
+    scored by predict_proba (a function of a float32 matrix) in a
+    background thread. Minibatches are copied in a preallocated buffer. """
+    def __init__(self, predict_proba, n_features, max_batch_size=MAX_BATCH_SIZE,
+                 max_wait=MAX_WAIT):
+        self.predict_proba = predict_proba
+        self.n_features = n_features
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = Queue.Queue()
+        self._carry = None  # request that did not fit in the last batch
+        self._buffer = numpy.empty((max_batch_size, n_features),
+                                   dtype='float32')
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, x):
+        """ Returns the probabilities of the rows of x (blocking) """
+        x = numpy.asarray(x, dtype='float32')
+        if x.ndim == 1:
+            return self.submit(x[numpy.newaxis])[0]
+        if x.ndim != 2 or x.shape[1] != self.n_features:
+            raise ValueError("expected rows of %i features, got shape %s"
+                             % (self.n_features, x.shape))
+        if x.shape[0] > self.max_batch_size:
+            return numpy.concatenate([self.submit(x[i:i+self.max_batch_size])
+                for i in xrange(0, x.shape[0], self.max_batch_size)], axis=0)
+        request = _Request(x)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        """ Blocks for a first request, then gathers the requests that
+        arrive within max_wait while the batch has room for them """
+        if self._carry is not None:
+            requests = [self._carry]
+            self._carry = None
+        else:
+            requests = [self._queue.get()]
+        n_rows = requests[0].x.shape[0]
+        deadline = time.time() + self.max_wait
+        while n_rows < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    request = self._queue.get(timeout=timeout)
+                else:
+                    request = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if n_rows + request.x.shape[0] > self.max_batch_size:
+                self._carry = request  # goes in the next batch
+                break
+            requests.append(request)
+            n_rows += request.x.shape[0]
+        return requests, n_rows
+
+    def _loop(self):
+        while True:
+            requests, n_rows = self._next_batch()
+            offset = 0
+            for request in requests:
+                n = request.x.shape[0]
+                self._buffer[offset:offset+n] = request.x
+                offset += n
+            try:
+                p_y_given_x = self.predict_proba(self._buffer[:n_rows])
+            except Exception, e:
+                for request in requests:
+                    request.error = e
+                    request.done.set()
+                continue
+            offset = 0
+            for request in requests:
+                n = request.x.shape[0]
+                request.result = numpy.array(p_y_given_x[offset:offset+n])
+                offset += n
+                request.done.set()
+
+
+def theano_predictor(path):
+    """ Loads the net saved (see model.save_model) in path and returns its
+    precompiled p_y_given_x function and its number of input features """
+    from model import load_model
+    nnet = load_model(path)
+    return nnet._function('predict_proba'), nnet.layers_ins[0]
+
+
+def numpy_predictor(path):
+    """ Loads the weights exported (see numpy_inference.export_weights) in
+    path and returns a NumPy p_y_given_x function and its number of input
+    features """
+    from numpy_inference import NumpyNet
+    nnet = NumpyNet(path, batch_size=MAX_BATCH_SIZE)
+    return nnet.predict_proba, nnet.n_ins
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        # readline as file iteration reads ahead and would wait for more
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                x = json.loads(line)['x']
+                response = {'p_y_given_x':
+                            self.server.batcher.submit(x).tolist()}
+            except Exception, e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class UnixScoringServer(SocketServer.ThreadingMixIn,
+                        SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, address, batcher):
+        SocketServer.UnixStreamServer.__init__(self, address, _Handler)
+        self.batcher = batcher
+
+
+class TCPScoringServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, batcher):
+        SocketServer.TCPServer.__init__(self, address, _Handler)
+        self.batcher = batcher
+
+
+def score_remote(address, x):
+    """ Client: returns the probabilities of x from the server at address
+    (a Unix socket path or a (host, port) pair) """
+    import socket
+    if isinstance(address, basestring):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(address)
+    try:
+        f = sock.makefile('rw')
+        f.write(json.dumps({'x': numpy.asarray(x).tolist()}) + '\n')
+        f.flush()
+        response = json.loads(f.readline())
+    finally:
+        sock.close()
+    if 'error' in response:
+        raise ValueError(response['error'])
+    return numpy.asarray(response['p_y_given_x'])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('model', help="directory of a model saved by "
+                                      "model.save_model (or weights file "
+                                      "with --backend numpy)")
+    parser.add_argument('--backend', choices=['theano', 'numpy'],
+                        default='theano')
+    parser.add_argument('--socket', help="Unix socket path to listen on")
+    parser.add_argument('--port', type=int, default=8765,
+                        help="loopback TCP port to listen on (if no socket)")
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--max-wait', type=float, default=MAX_WAIT)
+    args = parser.parse_args()
+    if args.backend == 'numpy':
+        predict_proba, n_features = numpy_predictor(args.model)
+    else:
+        predict_proba, n_features = theano_predictor(args.model)
+    batcher = MicroBatcher(predict_proba, n_features,
+                           max_batch_size=args.max_batch_size,
+                           max_wait=args.max_wait)
+    if args.socket:
+        server = UnixScoringServer(args.socket, batcher)
+    else:
+        server = TCPScoringServer(('127.0.0.1', args.port), batcher)
+    sys.stderr.write("serving %s on %s\n" % (args.model, server.server_address))
+    server.serve_forever()
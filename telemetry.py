@@ -0,0 +1,69 @@
+""" Training telemetry: callbacks of NeuralNet.fit and their JSON lines logs.
+
+    from telemetry import JSONLinesLogger
+    dnn.fit(X, y, callbacks=[JSONLinesLogger('train.jsonl')], profile=True)
+
+Each line of the log is a JSON object with an "event" key: "batch" (with
+batches=True), "epoch" (cost, train and dev errors, fetch/train/eval/snapshot
+seconds, samples_per_second) or "end" (with profile=True, the theano
+profile of the compiled trainer: its calls and the time spent per op).
+"""
+import json
+import time
+
+
+class Callback(object):
+    """ Base class of the callbacks of fit, which calls on_batch_end after
+    each training minibatch, on_epoch_end after each epoch and on_train_end
+    once, with the net and a dict of logs """
+    def on_batch_end(self, nnet, logs):
+        pass
+
+    def on_epoch_end(self, nnet, logs):
+        pass
+
+    def on_train_end(self, nnet, logs):
+        pass
+
+
+class JSONLinesLogger(Callback):
+    """ Appends the logs of the epochs (and of the minibatches if batches)
+    to the JSON lines file path """
+    def __init__(self, path, batches=False):
+        self.path = path
+        self.batches = batches
+        self._file = None
+
+    def _write(self, event, logs):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        record = dict(logs, event=event, time=time.time())
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def on_batch_end(self, nnet, logs):
+        if self.batches:
+            self._write('batch', logs)
+
+    def on_epoch_end(self, nnet, logs):
+        self._write('epoch', logs)
+        self._file.flush()
+
+    def on_train_end(self, nnet, logs):
+        self._write('end', logs)
+        self._file.close()
+        self._file = None
+
+
+def profile_stats(profile):
+    """ The stats of a theano ProfileStats (of a function compiled with
+    profile=True) as a dict: calls, seconds in the calls, compile seconds
+    and, per op, the calls and seconds sorted by decreasing time """
+    op_time = profile.op_time()
+    op_calls = profile.op_callcount()
+    return {'calls': profile.fct_callcount,
+            'call_seconds': profile.fct_call_time,
+            'vm_seconds': profile.vm_call_time,
+            'compile_seconds': profile.compile_time,
+            'ops': [{'op': str(op), 'seconds': t, 'calls': op_calls.get(op, 0)}
+                    for op, t in sorted(op_time.items(),
+                                        key=lambda item: -item[1])]}